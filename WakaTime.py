@@ -14,7 +14,11 @@ __version__ = '11.1.1'
 import sublime
 import sublime_plugin
 
+import errno
+import functools
+import hashlib
 import json
+import linecache
 import os
 import platform
 import re
@@ -22,11 +26,13 @@ import shutil
 import ssl
 import subprocess
 import sys
+import tempfile
 import time
 import threading
 import traceback
 import webbrowser
 from subprocess import STDOUT, PIPE
+from timeit import default_timer
 from zipfile import ZipFile
 
 try:
@@ -34,11 +40,33 @@ try:
 except ImportError:
     import queue  # py3
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None  # not bundled with Sublime Text 3
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    cProfile = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # added in Python 3.4
+try:
+    import zlib
+except ImportError:
+    zlib = None  # spooled heartbeats are written uncompressed
+
 try:
     from ConfigParser import SafeConfigParser as ConfigParser
     from ConfigParser import Error as ConfigParserError
 except ImportError:
     from configparser import ConfigParser, Error as ConfigParserError
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 try:
     from urllib2 import Request, urlopen, HTTPError
 except ImportError:
@@ -49,6 +77,7 @@ except ImportError:
 is_py2 = (sys.version_info[0] == 2)
 is_py3 = (sys.version_info[0] == 3)
 is_win = platform.system() == 'Windows'
+is_mac = platform.system() == 'Darwin'
 
 
 if is_py2:
@@ -117,6 +146,44 @@ class Popen(subprocess.Popen):
         super(Popen, self).__init__(*args, **kwargs)
 
 
+class SubprocessTimeout(Exception):
+    pass
+
+
+def communicate(process, inp=None, timeout=None):
+    """Like process.communicate, but kills the child process and raises
+    SubprocessTimeout when it runs longer than timeout seconds."""
+
+    timeout = timeout or SUBPROCESS_TIMEOUT
+    if is_py2:
+        # no communicate timeout on py2, so kill from a timer thread instead
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            output = process.communicate(input=inp)
+        finally:
+            timer.cancel()
+        if timed_out:
+            raise SubprocessTimeout('Killed after {0} seconds'.format(timeout))
+        return output
+
+    try:
+        return process.communicate(input=inp, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise SubprocessTimeout('Killed after {0} seconds'.format(timeout))
+
+
 # globals
 ST_VERSION = int(sublime.version())
 HOME_FOLDER = os.path.realpath(os.environ.get('WAKATIME_HOME') or os.path.expanduser('~'))
@@ -125,6 +192,7 @@ CONFIG_FILE = os.path.join(HOME_FOLDER, '.wakatime.cfg')
 INTERNAL_CONFIG_FILE = os.path.join(HOME_FOLDER, '.wakatime-internal.cfg')
 GITHUB_RELEASES_STABLE_URL = 'https://api.github.com/repos/wakatime/wakatime-cli/releases/latest'
 GITHUB_DOWNLOAD_PREFIX = 'https://github.com/wakatime/wakatime-cli/releases/download'
+GITHUB_LATEST_DOWNLOAD_PREFIX = 'https://github.com/wakatime/wakatime-cli/releases/latest/download'
 SETTINGS_FILE = 'WakaTime.sublime-settings'
 SETTINGS = {}
 LAST_HEARTBEAT = {
@@ -132,15 +200,30 @@ LAST_HEARTBEAT = {
     'file': None,
     'is_write': False,
 }
+WINDOW_SESSIONS = {}
+PLUGIN_UNLOADED = False
 LAST_HEARTBEAT_SENT_AT = 0
 LAST_FETCH_TODAY_CODING_TIME = 0
 FETCH_TODAY_DEBOUNCE_COUNTER = 0
 FETCH_TODAY_DEBOUNCE_SECONDS = 60
+TODAY_FETCHED = False
 LATEST_CLI_VERSION = None
 WAKATIME_CLI_LOCATION = None
 HEARTBEATS = queue.Queue()
 HEARTBEAT_FREQUENCY = 2  # minutes between logging heartbeat when editing same file
 SEND_BUFFER_SECONDS = 30  # seconds between sending buffered heartbeats to API
+HEARTBEAT_RATE_LIMIT = 30  # default max heartbeats queued per minute
+HEARTBEAT_BURST = 10  # default max heartbeats queued at once before rate limiting
+SUBPROCESS_TIMEOUT = 120  # seconds before killing a hung wakatime-cli process
+MAX_INFLIGHT_SENDS = 2  # max wakatime-cli processes sending heartbeats at once
+SPOOL_QUEUE_SIZE = 1000  # heartbeats held in memory while wakatime-cli is failing before spooling to disk
+LOCAL_DURATION_TIMEOUT = HEARTBEAT_FREQUENCY * 60 * 2  # default max seconds between heartbeats counted as coding time
+INSTALL_LOCK_TIMEOUT = 300  # seconds to wait for another Sublime process installing wakatime-cli
+LEADER_LEASE_SECONDS = 90  # seconds before a leader which stopped renewing is replaced
+LEADER_RENEW_SECONDS = 30  # seconds between leader lease renewals
+SHARED_TODAY_MAX_AGE = 300  # seconds a published today coding time is shown before fetching it again
+IDLE_TIMEOUT_SECONDS = 300  # seconds without input before the user is considered idle
+FOCUS_GRACE_SECONDS = 5  # seconds unfocused before the editor is considered idle
 
 
 # Log Levels
@@ -149,6 +232,11 @@ INFO = 'INFO'
 WARNING = 'WARNING'
 ERROR = 'ERROR'
 
+# Send Results
+SEND_ACCEPTED = 'accepted'  # sent, or saved offline by wakatime-cli
+SEND_RETRY = 'retry'  # not saved, but may succeed if sent again later
+SEND_FAILED = 'failed'  # rejected, for example a bad api key, so sending again won't help
+
 
 def parseConfigFile(configFile):
     """Returns a configparser.SafeConfigParser instance with configs
@@ -219,7 +307,7 @@ class ApiKey(object):
 
         try:
             process = Popen(vault_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-            stdout, stderr = process.communicate()
+            stdout, stderr = communicate(process)
             retcode = process.poll()
             if retcode:
                 log(ERROR, 'Vault command error ({retcode}): {stderr}'.format(retcode=retcode, stderr=u(stderr)))
@@ -271,6 +359,229 @@ def log(lvl, message, *args, **kwargs):
         set_timeout(lambda: log(lvl, message, *args, **kwargs), 0)
 
 
+class IdleTracker(object):
+    """Tracks editor focus and user input to detect when nobody is working.
+
+    While idle, queue flushes and today's coding time polling are deferred
+    and then run once when activity resumes.
+    """
+
+    def __init__(self):
+        self.focused = True
+        self.last_input = time.time()
+        self.blurred_at = 0
+        self.pending_flush = False
+        self.pending_status = None
+
+    def timeout(self):
+        return SETTINGS.get('idle_timeout') or IDLE_TIMEOUT_SECONDS
+
+    def is_idle(self, now=None):
+        now = now or time.time()
+        if not self.focused and now - self.blurred_at > FOCUS_GRACE_SECONDS:
+            return True
+        return now - self.last_input > self.timeout()
+
+    def activated(self):
+        self.touch()
+
+    def deactivated(self):
+        self.focused = False
+        self.blurred_at = time.time()
+
+    def touch(self):
+        """Records user input, resuming deferred work if we were idle."""
+
+        was_idle = self.is_idle()
+        self.focused = True
+        self.last_input = time.time()
+        if was_idle:
+            self.resume()
+
+    def defer_flush(self):
+        self.pending_flush = True
+
+    def defer_status(self, status):
+        self.pending_status = status
+
+    def resume(self):
+        log(DEBUG, 'Activity resumed after being idle.')
+        flush, status = self.pending_flush, self.pending_status
+        self.pending_flush, self.pending_status = False, None
+        if flush:
+            # listeners touch after queueing the heartbeat for the resuming
+            # input, so everything buffered while idle goes out in one flush
+            set_timeout(lambda: process_queue(LAST_HEARTBEAT['time']), 0)
+        if status:
+            update_status_bar(status)
+
+
+IDLE = IdleTracker()
+
+
+class PluginProfiler(object):
+    """Profiles the plugin in production, started and stopped from the
+    command palette.
+
+    While running, calls to functions wrapped with profiled are run under
+    cProfile and merged into one set of stats. Profiling hooks the listener
+    callbacks, the queue flush and the sender threads. When tracemalloc
+    is available it traces allocations between start and stop. Results go
+    to a timestamped folder in RESOURCES_FOLDER/sublime-profile.
+    """
+
+    TOP_FUNCTIONS = 40
+    TOP_MODULES = 20
+    TOP_ALLOCATIONS = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.stats = None
+        self.started = None
+        self.started_tracemalloc = False
+        self.snapshots = []
+
+    def available(self):
+        return cProfile is not None
+
+    def active(self):
+        return self.started is not None
+
+    def tracing_memory(self):
+        return tracemalloc is not None and self.active() and tracemalloc.is_tracing()
+
+    def start(self):
+        with self.lock:
+            if self.active() or not self.available():
+                return
+            self.stats = None
+            self.snapshots = []
+            self.started = time.time()
+            if tracemalloc is not None and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracemalloc = True
+        log(INFO, 'Started profiling the WakaTime plugin.')
+
+    def call(self, func, *args, **kwargs):
+        if not self.active() or getattr(self.local, 'profiling', False):
+            return func(*args, **kwargs)
+
+        # one profile per call, since cProfile only profiles the thread
+        # which enabled it
+        profile = cProfile.Profile()
+        self.local.profiling = True
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            self.local.profiling = False
+            with self.lock:
+                if not self.active():
+                    pass
+                elif self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def snapshot(self):
+        """Takes a tracemalloc snapshot, written out when profiling stops."""
+
+        if not self.tracing_memory():
+            return
+        snapshot = tracemalloc.take_snapshot()
+        with self.lock:
+            self.snapshots.append((time.time(), snapshot))
+
+    def stop(self):
+        """Stops profiling, returning the summary file path."""
+
+        self.snapshot()
+        with self.lock:
+            if not self.active():
+                return None
+            stats, self.stats = self.stats, None
+            snapshots, self.snapshots = self.snapshots, []
+            started, self.started = self.started, None
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+
+        folder = os.path.join(RESOURCES_FOLDER, 'sublime-profile', time.strftime('%Y%m%d-%H%M%S', time.localtime(started)))
+        try:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            if stats is not None:
+                stats.dump_stats(os.path.join(folder, 'plugin.pstats'))
+            for num, (_when, snapshot) in enumerate(snapshots):
+                snapshot.dump(os.path.join(folder, 'memory-{0}.tracemalloc'.format(num + 1)))
+            summary = os.path.join(folder, 'summary.txt')
+            with open(summary, 'w', encoding='utf-8') as fh:
+                fh.write(u(self.summary(stats, snapshots, started)))
+        except:
+            log(ERROR, 'Unable to write profile: {0}'.format(u(sys.exc_info()[1])))
+            return None
+        log(INFO, 'Stopped profiling the WakaTime plugin, results written to {0}'.format(folder))
+        return summary
+
+    def summary(self, stats, snapshots, started):
+        out = StringIO()
+        out.write('WakaTime plugin v{0} profile, Sublime Text {1}, {2:.1f} seconds\n\n'.format(
+            __version__, ST_VERSION, time.time() - started))
+
+        if stats is None:
+            out.write('No plugin callbacks ran while profiling.\n')
+        else:
+            modules = {}
+            for (filename, _lineno, _func), (_cc, _nc, tt, _ct, _callers) in stats.stats.items():
+                modules[filename] = modules.get(filename, 0) + tt
+            out.write('Time by module:\n')
+            for filename, seconds in sorted(modules.items(), key=lambda x: -x[1])[:self.TOP_MODULES]:
+                out.write('  {0:10.4f}s  {1}\n'.format(seconds, filename))
+
+            out.write('\nTop functions by cumulative time:\n')
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(self.TOP_FUNCTIONS)
+
+        if not snapshots:
+            out.write('\nNo memory snapshots, tracemalloc is not available.\n' if tracemalloc is None else '\nNo memory snapshots.\n')
+            return out.getvalue()
+
+        # leave out the profiler's own allocations
+        exclude = [tracemalloc.Filter(False, module.__file__) for module in (cProfile, pstats, tracemalloc)]
+        snapshots = [(when, snapshot.filter_traces(exclude)) for when, snapshot in snapshots]
+        _when, snapshot = snapshots[-1]
+        out.write('\nAllocations by module:\n')
+        for stat in snapshot.statistics('filename')[:self.TOP_MODULES]:
+            out.write('  {0:10.1f} KiB  {1:8d} blocks  {2}\n'.format(stat.size / 1024.0, stat.count, stat.traceback[0].filename))
+
+        out.write('\nTop plugin allocation sites:\n')
+        plugin = snapshot.filter_traces([tracemalloc.Filter(True, __file__)])
+        for stat in plugin.statistics('lineno')[:self.TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            out.write('  {0:10.1f} KiB  {1:8d} blocks  line {2}: {3}\n'.format(
+                stat.size / 1024.0, stat.count, frame.lineno, linecache.getline(frame.filename, frame.lineno).strip()))
+
+        if len(snapshots) > 1:
+            out.write('\nGrowth between first and last snapshot:\n')
+            for stat in snapshot.compare_to(snapshots[0][1], 'lineno')[:self.TOP_ALLOCATIONS]:
+                frame = stat.traceback[0]
+                out.write('  {0:+10.1f} KiB  {1}:{2}\n'.format(stat.size_diff / 1024.0, frame.filename, frame.lineno))
+
+        return out.getvalue()
+
+
+PROFILER = PluginProfiler()
+
+
+def profiled(func):
+    """Runs func under PROFILER while profiling is started."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return PROFILER.call(func, *args, **kwargs)
+    return wrapper
+
+
 def update_status_bar(status=None, debounced=False, msg=None):
     """Updates the status bar."""
     global LAST_FETCH_TODAY_CODING_TIME, FETCH_TODAY_DEBOUNCE_COUNTER
@@ -280,12 +591,15 @@ def update_status_bar(status=None, debounced=False, msg=None):
             if SETTINGS.get('status_bar_coding_activity') and status == 'OK':
                 if debounced:
                     FETCH_TODAY_DEBOUNCE_COUNTER -= 1
+                if IDLE.is_idle():
+                    IDLE.defer_status(status)
+                    return
                 if debounced or not LAST_FETCH_TODAY_CODING_TIME:
                     now = int(time.time())
                     if LAST_FETCH_TODAY_CODING_TIME and (FETCH_TODAY_DEBOUNCE_COUNTER > 0 or LAST_FETCH_TODAY_CODING_TIME > now - FETCH_TODAY_DEBOUNCE_SECONDS):
                         return
                     LAST_FETCH_TODAY_CODING_TIME = now
-                    FetchStatusBarCodingTime().start()
+                    fetch_today_coding_time()
                     return
                 else:
                     FETCH_TODAY_DEBOUNCE_COUNTER += 1
@@ -304,6 +618,85 @@ def update_status_bar(status=None, debounced=False, msg=None):
         set_timeout(lambda: update_status_bar(status=status, debounced=debounced, msg=msg), 0)
 
 
+def fetch_today_coding_time():
+    """Refreshes today's coding time in the status bar.
+
+    Only the leader Sublime process runs wakatime-cli for this. The others
+    ask it for a refresh and show what it published, or the local coding
+    time until it does. When the leader's lease goes stale, is_leader takes
+    over and this process fetches it instead.
+    """
+
+    if not LEADER.is_leader():
+        request_shared_today()
+        shared = read_shared_today()
+        if shared:
+            update_status_bar(msg='Today: {output}'.format(output=shared))
+        else:
+            show_local_today()
+        return
+    if not TODAY_FETCHED or not BREAKER.is_closed():
+        show_local_today()
+    if BREAKER.is_closed():
+        FetchStatusBarCodingTime().start()
+
+
+def show_local_today():
+    """Shows today's coding time from the local duration engine, used until
+    wakatime-cli reports it or when wakatime-cli is offline."""
+
+    def show():
+        DURATIONS.refresh(max_age=DURATIONS.REFRESH_SECONDS)
+        update_status_bar(msg='Today: {0}'.format(format_duration(DURATIONS.today_seconds())))
+
+    # refreshing reads the local database, keep it off the UI thread
+    set_timeout(show, 0)
+
+
+def shared_today_file():
+    return os.path.join(RESOURCES_FOLDER, 'sublime-today.json')
+
+
+def publish_shared_today(output):
+    try:
+        writeFileAtomic(shared_today_file(), json.dumps({'output': output, 'time': time.time()}))
+    except:
+        log(DEBUG, traceback.format_exc())
+
+
+def read_shared_today(max_age=SHARED_TODAY_MAX_AGE):
+    try:
+        with open(shared_today_file(), 'r', encoding='utf-8') as fh:
+            shared = json.loads(fh.read())
+        if shared.get('time', 0) > time.time() - max_age:
+            return shared.get('output')
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def shared_today_request_file():
+    return os.path.join(RESOURCES_FOLDER, 'sublime-today.request')
+
+
+def request_shared_today():
+    """Asks the leader to keep publishing today's coding time."""
+
+    try:
+        with open(shared_today_request_file(), 'a', encoding='utf-8'):
+            pass
+        os.utime(shared_today_request_file(), None)
+    except (IOError, OSError):
+        log(DEBUG, traceback.format_exc())
+
+
+def shared_today_requested():
+    try:
+        return os.path.getmtime(shared_today_request_file()) > time.time() - SHARED_TODAY_MAX_AGE
+    except OSError:
+        return False
+
+
 class FetchStatusBarCodingTime(threading.Thread):
 
     def __init__(self):
@@ -313,7 +706,10 @@ class FetchStatusBarCodingTime(threading.Thread):
         self.api_key = APIKEY.read() or ''
         self.proxy = SETTINGS.get('proxy')
 
+    @profiled
     def run(self):
+        global TODAY_FETCHED
+
         if not self.api_key:
             log(DEBUG, 'Missing WakaTime API key.')
             return
@@ -336,7 +732,7 @@ class FetchStatusBarCodingTime(threading.Thread):
         log(DEBUG, ' '.join(obfuscate_apikey(cmd)))
         try:
             process = Popen(cmd, stdout=PIPE, stderr=STDOUT)
-            output, err = process.communicate()
+            output, err = communicate(process)
             output = u(output)
             if output:
                 output = output.strip()
@@ -344,12 +740,15 @@ class FetchStatusBarCodingTime(threading.Thread):
             if not retcode and output:
                 msg = 'Today: {output}'.format(output=output)
                 update_status_bar(msg=msg)
+                publish_shared_today(output)
+                TODAY_FETCHED = True
             else:
                 log(DEBUG, 'wakatime-core today exited with status: {0}'.format(retcode))
                 if output:
                     log(DEBUG, u('wakatime-core today output: {0}').format(output))
+                show_local_today()
         except:
-            pass
+            show_local_today()
 
 
 def prompt_api_key():
@@ -380,33 +779,174 @@ def obfuscate_apikey(command_list):
     return cmd
 
 
-def enough_time_passed(now, is_write):
-    if now - LAST_HEARTBEAT['time'] > HEARTBEAT_FREQUENCY * 60:
+def enough_time_passed(now, is_write, last_time=None):
+    if last_time is None:
+        last_time = LAST_HEARTBEAT['time']
+    if now - last_time > HEARTBEAT_FREQUENCY * 60:
         return True
-    if is_write and now - LAST_HEARTBEAT['time'] > 2:
+    if is_write and now - last_time > 2:
         return True
     return False
 
 
-def find_folder_containing_file(folders, current_file):
-    """Returns absolute path to folder containing the file.
+class WindowSession(object):
+    """Activity state for one Sublime window.
+
+    Holds the last heartbeat sent from the window and caches the window's
+    folders and project name. Only the project name is kept from the
+    window's project data, which is re-read when the project changes.
     """
 
-    parent_folder = None
+    def __init__(self, window_id):
+        self.window_id = window_id
+        self.last_file = None
+        self.last_time = 0
+        self.folders = None
+        self.project_name = None
+        self.project_file = None
+
+    def record_heartbeat(self, entity, timestamp):
+        self.last_file = entity
+        self.last_time = timestamp
+
+    def resolve_project(self, window):
+        """Returns (project_name, folders) for the window, re-reading project
+        data only when the folders or the project file changed."""
+
+        folders = window.folders()
+        project_file = window.project_file_name() if hasattr(window, 'project_file_name') else None
+        if self.folders is None or folders != self.folders or project_file != self.project_file:
+            self.folders = folders
+            self.project_file = project_file
+            self.project_name = self.read_project_name(window)
+        return self.project_name, self.folders
+
+    def read_project_name(self, window):
+        # project_data() deserializes the whole .sublime-project file, so
+        # only keep the name and let the rest be garbage collected
+        project = window.project_data() if hasattr(window, 'project_data') else None
+        return project.get('name') if project else None
+
+    def invalidate_project(self):
+        self.folders = None
+        self.project_name = None
+
+
+def get_window_session(window):
+    session = WINDOW_SESSIONS.get(window.id())
+    if session is None:
+        prune_window_sessions()
+        session = WindowSession(window.id())
+        WINDOW_SESSIONS[window.id()] = session
+    return session
+
+
+def prune_window_sessions():
+    """Drops sessions for windows which no longer exist.
+
+    Sublime Text 4 tells us when a window closes, but older versions don't so
+    stale sessions are also pruned whenever a new one is created.
+    """
 
-    current_folder = current_file
-    while True:
-        for folder in folders:
-            if os.path.realpath(os.path.dirname(current_folder)) == os.path.realpath(folder):
-                parent_folder = folder
-                break
-        if parent_folder is not None:
-            break
-        if not current_folder or os.path.dirname(current_folder) == current_folder:
-            break
-        current_folder = os.path.dirname(current_folder)
+    open_windows = set(w.id() for w in sublime.windows())
+    for window_id in list(WINDOW_SESSIONS.keys()):
+        if window_id not in open_windows:
+            del WINDOW_SESSIONS[window_id]
+
+
+def close_window_session(window):
+    WINDOW_SESSIONS.pop(window.id(), None)
+
+
+class EntityCache(object):
+    """Canonical entity paths, resolved once per view and interned.
+
+    Every heartbeat for a file shares one path string, which keeps long
+    queues small and makes comparing equal paths cheap. Paths are resolved with realpath, and on
+    case-insensitive filesystems paths differing only by case intern to the
+    same string. Unsaved buffers have no entity, and remote buffers named
+    by a URL are kept as-is.
+    """
+
+    MAX_ENTRIES = 10000
+    REMOTE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]+://')
+
+    def __init__(self):
+        self.views = {}
+        self.paths = {}
+        self.interned = {}
+        self.folders = {}
+        self.real_folders = {}
+
+    def for_view(self, view):
+        file_name = view.file_name()
+        if not file_name:
+            return None
+        cached = self.views.get(view.buffer_id())
+        if cached and cached[0] == file_name:
+            return cached[1]
+        entity = self.entity(file_name)
+        self.bound(self.views)[view.buffer_id()] = (file_name, entity)
+        return entity
+
+    def entity(self, path):
+        entity = self.paths.get(path)
+        if entity is None:
+            canonical = path if self.is_remote(path) else os.path.realpath(path)
+            entity = self.bound(self.interned).setdefault(self.key(canonical), canonical)
+            self.bound(self.paths)[path] = entity
+        return entity
+
+    def folder(self, entity, folders):
+        """Returns the project folder containing entity, or None."""
+
+        cache_key = (entity, tuple(folders))
+        try:
+            return self.folders[cache_key]
+        except KeyError:
+            pass
+        folder = None
+        if not self.is_remote(entity):
+            roots = dict((self.real_folder(x), x) for x in folders)
+            current = self.key(self.entity(entity))
+            while True:
+                parent = os.path.dirname(current)
+                if parent in roots:
+                    folder = roots[parent]
+                    break
+                if not parent or parent == current:
+                    break
+                current = parent
+        self.bound(self.folders)[cache_key] = folder
+        return folder
+
+    def real_folder(self, folder):
+        real = self.real_folders.get(folder)
+        if real is None:
+            real = self.bound(self.real_folders)[folder] = self.key(os.path.realpath(folder))
+        return real
+
+    def key(self, path):
+        return path.lower() if is_win or is_mac else path
+
+    def is_remote(self, path):
+        return self.REMOTE.match(path) is not None
+
+    def bound(self, cache):
+        # a plain reset keeps memory bounded, entries are cheap to rebuild
+        if len(cache) >= self.MAX_ENTRIES:
+            cache.clear()
+        return cache
+
+
+ENTITIES = EntityCache()
+
+
+def find_folder_containing_file(folders, current_file):
+    """Returns absolute path to folder containing the file.
+    """
 
-    return parent_folder
+    return ENTITIES.folder(current_file, folders)
 
 
 def find_project_from_folders(folders, current_file):
@@ -417,33 +957,628 @@ def find_project_from_folders(folders, current_file):
     return os.path.basename(folder) if folder else None
 
 
+class BranchCache(object):
+    """Caches the git branch of each project folder, re-reading .git/HEAD
+    only when its mtime changes."""
+
+    def __init__(self):
+        self.heads = {}
+        self.branches = {}
+
+    def branch(self, folder):
+        head = self.head_file(folder)
+        if not head:
+            return None
+        try:
+            mtime = os.path.getmtime(head)
+        except OSError:
+            self.heads.pop(folder, None)
+            return None
+        cached = self.branches.get(head)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        branch = None
+        try:
+            with open(head, 'r', encoding='utf-8') as fh:
+                ref = fh.read().strip()
+            if ref.startswith('ref: refs/heads/'):
+                branch = ref[len('ref: refs/heads/'):]
+        except IOError:
+            pass
+        self.branches[head] = (mtime, branch)
+        return branch
+
+    def head_file(self, folder):
+        head = self.heads.get(folder)
+        if head:
+            return head
+        git = os.path.join(folder, '.git')
+        if os.path.isdir(git):
+            head = os.path.join(git, 'HEAD')
+        elif os.path.isfile(git):
+            # worktrees and submodules point to their git dir from a .git file
+            try:
+                with open(git, 'r', encoding='utf-8') as fh:
+                    gitdir = fh.read().strip()
+                if gitdir.startswith('gitdir:'):
+                    head = os.path.join(folder, gitdir[len('gitdir:'):].strip(), 'HEAD')
+            except IOError:
+                pass
+        if head:
+            self.heads[folder] = head
+        return head
+
+
+BRANCHES = BranchCache()
+SYNTAX_LANGUAGES = {}
+
+
+def view_language(view):
+    """Returns the language name of the view's syntax, cached per syntax."""
+
+    syntax = view.settings().get('syntax')
+    if not syntax:
+        return None
+    try:
+        return SYNTAX_LANGUAGES[syntax]
+    except KeyError:
+        pass
+    name = None
+    if hasattr(view, 'syntax') and view.syntax():
+        name = view.syntax().name
+    if not name:
+        name = os.path.splitext(os.path.basename(syntax))[0]
+    language = None if name.lower() == 'plain text' else name
+    SYNTAX_LANGUAGES[syntax] = language
+    return language
+
+
+def heartbeat_project_name(entity, project, folders):
+    """Returns the alternate project name for a queued heartbeat."""
+
+    if project:
+        return project
+    if folders:
+        return find_project_from_folders(folders, entity)
+    return None
+
+
 def is_view_active(view):
+    """Returns True when the view is focused in the focused window.
+
+    Views in background windows, including clones of the active buffer and
+    files reloaded from disk, are not considered active.
+    """
+
     if view:
+        window = view.window()
         active_window = sublime.active_window()
-        if active_window:
+        if window and active_window and window.id() == active_window.id():
             active_view = active_window.active_view()
             if active_view:
                 return active_view.buffer_id() == view.buffer_id()
     return False
 
 
-def handle_activity(view, is_write=False):
+def handle_activity(view, is_write=False, kind='modified'):
     window = view.window()
     if window is not None:
-        entity = view.file_name()
+        entity = ENTITIES.for_view(view)
         if entity:
             timestamp = time.time()
-            last_file = LAST_HEARTBEAT['file']
-            if entity != last_file or enough_time_passed(timestamp, is_write):
-                project = window.project_data() if hasattr(window, 'project_data') else None
-                folders = window.folders()
-                append_heartbeat(entity, timestamp, is_write, view, project, folders)
+            TRACE.record_event(kind, timestamp, view, window, entity)
+            session = get_window_session(window)
+            # entities are interned, so these usually compare as the same object
+            if entity != LAST_HEARTBEAT['file'] or entity != session.last_file or enough_time_passed(timestamp, is_write, session.last_time):
+                project_name, folders = session.resolve_project(window)
+                append_heartbeat(entity, timestamp, is_write, view, project_name, folders, session=session)
 
 
-def append_heartbeat(entity, timestamp, is_write, view, project, folders):
-    global LAST_HEARTBEAT
+class TraceRecorder(object):
+    """Records listener events and the heartbeats they produce to a JSONL
+    trace file, for replaying real editing sessions offline.
 
-    # add this heartbeat to queue
+    Enabled with the trace_activity setting. Lines are buffered in memory
+    and written from a background timer to keep file IO off the UI thread.
+    """
+
+    FLUSH_SECONDS = 1
+
+    def __init__(self):
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.flush_scheduled = False
+
+    def enabled(self):
+        return bool(SETTINGS.get('trace_activity'))
+
+    def path(self):
+        return SETTINGS.get('trace_file') or os.path.join(RESOURCES_FOLDER, 'sublime-trace.jsonl')
+
+    def record_event(self, kind, timestamp, view, window=None, entity=None):
+        if not self.enabled():
+            return
+        self.write({
+            'e': 'event',
+            'kind': kind,
+            't': timestamp,
+            'view': view.id(),
+            'window': window.id() if window else None,
+            'entity': entity,
+        })
+
+    def record_heartbeat(self, heartbeat):
+        if not self.enabled():
+            return
+        self.write({
+            'e': 'heartbeat',
+            't': heartbeat['timestamp'],
+            'entity': heartbeat['entity'],
+            'is_write': heartbeat['is_write'],
+            'project': heartbeat.get('project'),
+            'lineno': heartbeat.get('lineno'),
+            'cursorpos': heartbeat.get('cursorpos'),
+            'lines': heartbeat.get('lines_in_file'),
+        })
+
+    def write(self, record):
+        with self.lock:
+            self.buffer.append(record)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        set_timeout(self.flush, self.FLUSH_SECONDS)
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+            self.flush_scheduled = False
+        if not records:
+            return
+        try:
+            path = self.path()
+            folder = os.path.dirname(path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(path, 'a', encoding='utf-8') as fh:
+                for record in records:
+                    fh.write(u(json.dumps(record, separators=(',', ':'))) + u('\n'))
+        except:
+            log(DEBUG, traceback.format_exc())
+
+
+TRACE = TraceRecorder()
+
+
+def duration_timeout():
+    return SETTINGS.get('duration_timeout') or LOCAL_DURATION_TIMEOUT
+
+
+def credited_seconds(gap, timeout):
+    """Returns seconds of coding time between two consecutive heartbeats."""
+
+    return gap if 0 < gap <= timeout else 0
+
+
+def compute_durations(heartbeats, timeout):
+    """Batch version of DurationEngine for recomputing historical ranges.
+
+    Takes (time, entity, project, language) tuples sorted by time and returns
+    a dict of (day, project, entity, language) to seconds. Gaps are computed over the
+    whole time column at once instead of one heartbeat at a time.
+    """
+
+    times = [h[0] for h in heartbeats]
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    totals = {}
+    days = {}
+    for heartbeat, gap in zip(heartbeats, gaps):
+        seconds = credited_seconds(gap, timeout)
+        if not seconds:
+            continue
+        minute = int(heartbeat[0] // 60)
+        day = days.get(minute)
+        if day is None:
+            day = days[minute] = day_of(heartbeat[0])
+        key = (day, heartbeat[2] or '', heartbeat[1], heartbeat[3] or '')
+        totals[key] = totals.get(key, 0) + seconds
+    return totals
+
+
+class DurationEngine(object):
+    """Streaming coding time totals for today per entity, project and
+    language, updated in constant time as each heartbeat arrives.
+
+    Time between two heartbeats counts towards the earlier heartbeat when
+    they are at most duration_timeout seconds apart.
+
+    When the local activity database is enabled it holds the real totals,
+    including other Sublime processes, and the engine is a cache in front
+    of it that is refreshed from the database. Otherwise totals are
+    checkpointed to disk so they survive restarting Sublime.
+    """
+
+    GROUPS = ('entity', 'project', 'language')
+    CHECKPOINT_SECONDS = 60
+    REFRESH_SECONDS = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = None
+        self.reset(None)
+        self.checkpoint_scheduled = False
+        self.refreshed_at = 0
+
+    def reset(self, day):
+        self.day = day
+        self.total = 0
+        self.totals = dict((group, {}) for group in self.GROUPS)
+
+    def path(self):
+        return os.path.join(RESOURCES_FOLDER, 'sublime-durations.json')
+
+    def add(self, timestamp, entity, project=None, language=None):
+        with self.lock:
+            if self.last:
+                seconds = credited_seconds(timestamp - self.last[0], duration_timeout())
+                if seconds:
+                    self.credit(day_of(self.last[0]), self.last, seconds)
+            if not self.last or timestamp >= self.last[0]:
+                self.last = (timestamp, entity, project, language)
+        self.schedule_checkpoint()
+
+    def credit(self, day, heartbeat, seconds):
+        if day != self.day:
+            if self.day and day < self.day:
+                return  # late heartbeat from a previous day
+            self.reset(day)
+        self.total += seconds
+        for group, name in zip(self.GROUPS, heartbeat[1:]):
+            if name:
+                self.totals[group][name] = self.totals[group].get(name, 0) + seconds
+
+    def today_seconds(self):
+        with self.lock:
+            return self.total if self.day == day_of(time.time()) else 0
+
+    def summary(self, group):
+        """Returns list of (name, seconds) for today, longest first."""
+
+        with self.lock:
+            if self.day != day_of(time.time()):
+                return []
+            return sorted(self.totals[group].items(), key=lambda x: x[1], reverse=True)
+
+    def refresh(self, max_age=0):
+        """Replaces today's totals with the local database's. Returns False
+        when the database isn't available."""
+
+        if not LOCAL_STORE.enabled():
+            return False
+        if max_age and self.refreshed_at > time.time() - max_age:
+            return True
+        today = day_of(time.time())
+        totals = dict((group, LOCAL_STORE.totals(today, today, group_by=group)) for group in self.GROUPS)
+        if not LOCAL_STORE.enabled():
+            return False  # failed to open the database
+        with self.lock:
+            self.reset(today)
+            for group in self.GROUPS:
+                self.totals[group] = dict((name, seconds) for name, seconds in totals[group] if name)
+            self.total = sum(seconds for _, seconds in totals['project'])
+            self.refreshed_at = time.time()
+        return True
+
+    def schedule_checkpoint(self):
+        if self.checkpoint_scheduled or LOCAL_STORE.enabled():
+            return
+        self.checkpoint_scheduled = True
+        set_timeout(self.checkpoint, self.CHECKPOINT_SECONDS)
+
+    def checkpoint(self):
+        with self.lock:
+            self.checkpoint_scheduled = False
+            state = {
+                'day': self.day,
+                'last': self.last,
+                'total': self.total,
+                'totals': self.totals,
+            }
+        if LOCAL_STORE.enabled():
+            return  # the local database already has the totals
+        try:
+            if not os.path.exists(RESOURCES_FOLDER):
+                os.makedirs(RESOURCES_FOLDER)
+            writeFileAtomic(self.path(), json.dumps(state))
+        except:
+            log(DEBUG, traceback.format_exc())
+
+    def load(self):
+        if self.refresh():
+            return
+        try:
+            with open(self.path(), 'r', encoding='utf-8') as fh:
+                state = json.loads(fh.read())
+        except (IOError, OSError, ValueError):
+            return
+        with self.lock:
+            if self.last is not None:
+                return  # already tracking heartbeats from this session
+            self.last = tuple(state['last']) if state.get('last') else None
+            if state.get('day') == day_of(time.time()):
+                self.day = state['day']
+                self.total = state.get('total', 0)
+                for group in self.GROUPS:
+                    self.totals[group] = state.get('totals', {}).get(group, {})
+
+
+DURATIONS = DurationEngine()
+
+
+class ActivityStore(object):
+    """Local SQLite database of heartbeats and coding time per day, project
+    and file, for showing coding time without wakatime-cli.
+
+    Totals are updated incrementally with the same rule as DurationEngine,
+    and recomputed in batch when the duration_timeout setting changes.
+    Several Sublime processes may share the database, so each heartbeat is
+    credited against its neighbours in the database rather than the last
+    heartbeat this process saw.
+    """
+
+    REBUILD_CHUNK_SECONDS = 86400
+    SCHEMA_VERSION = '2'
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS heartbeats (time REAL NOT NULL, entity TEXT NOT NULL, project TEXT, language TEXT, is_write INTEGER NOT NULL DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS heartbeats_time ON heartbeats (time)',
+        'CREATE TABLE IF NOT EXISTS durations (day TEXT NOT NULL, project TEXT NOT NULL, entity TEXT NOT NULL, language TEXT NOT NULL, seconds REAL NOT NULL DEFAULT 0, PRIMARY KEY (day, project, entity, language))',
+        'CREATE INDEX IF NOT EXISTS durations_project_day ON durations (project, day)',
+        'CREATE INDEX IF NOT EXISTS durations_entity_day ON durations (entity, day)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    ]
+
+    def __init__(self):
+        self.conn = None
+        self.disabled = False
+        self.lock = threading.Lock()
+
+    def path(self):
+        return os.path.join(RESOURCES_FOLDER, 'sublime-activity.db')
+
+    def enabled(self):
+        return sqlite3 is not None and not self.disabled and SETTINGS.get('local_activity_db') is not False
+
+    def connect(self):
+        if self.conn is not None:
+            return self.conn
+        if sqlite3 is None:
+            log(DEBUG, 'Local activity database disabled because sqlite3 is not available.')
+            self.disabled = True
+            return None
+        try:
+            if not os.path.exists(RESOURCES_FOLDER):
+                os.makedirs(RESOURCES_FOLDER)
+            conn = sqlite3.connect(self.path(), check_same_thread=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            row = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+            if not row or row[0] != self.SCHEMA_VERSION:
+                # durations are recomputed from the heartbeats below
+                conn.execute('DROP TABLE IF EXISTS durations')
+                conn.execute("DELETE FROM meta WHERE key = 'timeout'")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('schema', ?)", (self.SCHEMA_VERSION,))
+            conn.commit()
+            self.conn = conn
+            row = conn.execute("SELECT value FROM meta WHERE key = 'timeout'").fetchone()
+            if not row or float(row[0]) != duration_timeout():
+                self.rebuild(conn)
+        except:
+            log(DEBUG, traceback.format_exc())
+            self.disabled = True
+        return self.conn
+
+    def record(self, timestamp, entity, project, language=None, is_write=False):
+        with self.lock:
+            conn = self.connect()
+            if conn is None:
+                return
+            try:
+                # lock the database for the lookups and writes, so another
+                # process can't insert between them
+                conn.execute('BEGIN IMMEDIATE')
+                previous = conn.execute('SELECT time, entity, project, language FROM heartbeats WHERE time <= ? ORDER BY time DESC LIMIT 1', (timestamp,)).fetchone()
+                following = conn.execute('SELECT time FROM heartbeats WHERE time > ? ORDER BY time LIMIT 1', (timestamp,)).fetchone()
+                conn.execute('INSERT INTO heartbeats (time, entity, project, language, is_write) VALUES (?, ?, ?, ?, ?)',
+                             (timestamp, entity, project, language, 1 if is_write else 0))
+                timeout = duration_timeout()
+                if previous:
+                    prev_time, prev_entity, prev_project, prev_language = previous
+                    if following:
+                        # the gap this heartbeat splits was already credited
+                        self.add_seconds(conn, day_of(prev_time), prev_project, prev_entity, prev_language, -credited_seconds(following[0] - prev_time, timeout))
+                    self.add_seconds(conn, day_of(prev_time), prev_project, prev_entity, prev_language, credited_seconds(timestamp - prev_time, timeout))
+                if following:
+                    self.add_seconds(conn, day_of(timestamp), project, entity, language, credited_seconds(following[0] - timestamp, timeout))
+                conn.commit()
+            except:
+                conn.rollback()
+                log(DEBUG, traceback.format_exc())
+
+    def add_seconds(self, conn, day, project, entity, language, seconds):
+        if not seconds:
+            return
+        key = (day, project or '', entity, language or '')
+        conn.execute('INSERT OR IGNORE INTO durations (day, project, entity, language, seconds) VALUES (?, ?, ?, ?, 0)', key)
+        conn.execute('UPDATE durations SET seconds = seconds + ? WHERE day = ? AND project = ? AND entity = ? AND language = ?', (seconds,) + key)
+
+    def rebuild(self, conn):
+        """Recomputes all durations from the stored heartbeats, reading
+        them one day at a time to keep memory flat for long histories."""
+
+        timeout = duration_timeout()
+        log(DEBUG, 'Recomputing local coding time with a {0} second timeout.'.format(timeout))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM durations')
+            previous = None
+            start = conn.execute('SELECT MIN(time) FROM heartbeats').fetchone()[0]
+            while start is not None:
+                end = start + self.REBUILD_CHUNK_SECONDS
+                heartbeats = conn.execute('SELECT time, entity, project, language FROM heartbeats WHERE time >= ? AND time < ? ORDER BY time', (start, end)).fetchall()
+                if previous:
+                    # credits the gap from the previous chunk's last heartbeat
+                    heartbeats.insert(0, previous)
+                for (day, project, entity, language), seconds in compute_durations(heartbeats, timeout).items():
+                    self.add_seconds(conn, day, project, entity, language, seconds)
+                previous = heartbeats[-1] if heartbeats else previous
+                start = conn.execute('SELECT MIN(time) FROM heartbeats WHERE time >= ?', (end,)).fetchone()[0]
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('timeout', ?)", (str(float(timeout)),))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+    def totals(self, start_day, end_day, group_by='project'):
+        """Returns list of (name, seconds) between two days, inclusive,
+        grouped by project, entity, language or day, longest first."""
+
+        if group_by not in ('project', 'entity', 'language', 'day'):
+            raise ValueError('Unsupported grouping: {0}'.format(group_by))
+        with self.lock:
+            conn = self.connect() if self.enabled() else None
+            if conn is None:
+                return []
+            query = 'SELECT {col}, SUM(seconds) FROM durations WHERE day BETWEEN ? AND ? GROUP BY {col} ORDER BY 2 DESC'.format(col=group_by)
+            return [tuple(row) for row in conn.execute(query, (start_day, end_day))]
+
+    def today_seconds(self):
+        today = day_of(time.time())
+        return sum(seconds for _, seconds in self.totals(today, today, group_by='day'))
+
+
+LOCAL_STORE = ActivityStore()
+
+
+def record_local_activity(heartbeat):
+    """Feeds a queued heartbeat to the duration engine and local database
+    from a background thread."""
+
+    entity, timestamp, is_write = heartbeat['entity'], heartbeat['timestamp'], heartbeat['is_write']
+    project, folders, language = heartbeat.get('project'), heartbeat.get('folders'), heartbeat.get('language')
+
+    def record():
+        project_name = heartbeat_project_name(entity, project, folders)
+        DURATIONS.add(timestamp, entity, project_name, language)
+        if LOCAL_STORE.enabled():
+            LOCAL_STORE.record(timestamp, entity, project_name, language=language, is_write=is_write)
+
+    set_timeout(record, 0)
+
+
+def day_of(timestamp):
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+
+def format_duration(seconds):
+    """Formats seconds like wakatime-cli's --today output."""
+
+    hours, minutes = int(seconds // 3600), int(seconds % 3600 // 60)
+    parts = []
+    if hours:
+        parts.append('{0} hr{1}'.format(hours, '' if hours == 1 else 's'))
+    if minutes or not hours:
+        parts.append('{0} min{1}'.format(minutes, '' if minutes == 1 else 's'))
+    return ' '.join(parts)
+
+
+class RateLimiter(object):
+    """Token bucket in front of the heartbeat queue.
+
+    Allows heartbeat_rate_limit heartbeats per minute, with bursts of up to
+    heartbeat_burst. Macros, replace in files and plugins editing views can
+    produce hundreds of heartbeats at once. During such a burst the latest
+    heartbeat per file is held back, and once it quiets down the most
+    recently touched files are queued as a summary of the burst.
+    """
+
+    QUIET_SECONDS = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = None
+        self.updated = 0
+        self.held = {}
+        self.last_suppressed = 0
+        self.flush_scheduled = False
+        self.suppressed = 0
+        self.bursts = 0
+
+    def rate(self):
+        return float(SETTINGS.get('heartbeat_rate_limit') or HEARTBEAT_RATE_LIMIT) / 60
+
+    def capacity(self):
+        return SETTINGS.get('heartbeat_burst') or HEARTBEAT_BURST
+
+    def allow(self, heartbeat, session=None):
+        """Returns True when the heartbeat may be queued now, otherwise holds
+        it for the burst summary."""
+
+        now = heartbeat['timestamp']
+        with self.lock:
+            if self.tokens is None:
+                self.tokens = self.capacity()
+            self.tokens = min(self.capacity(), self.tokens + max(now - self.updated, 0) * self.rate())
+            self.updated = now
+            if self.tokens >= 1 and not self.held:
+                self.tokens -= 1
+                return True
+
+            previous = self.held.get(heartbeat['entity'])
+            if previous:
+                heartbeat['is_write'] = heartbeat['is_write'] or previous[0]['is_write']
+            self.held[heartbeat['entity']] = (heartbeat, session)
+            self.suppressed += 1
+            self.last_suppressed = now
+            if self.flush_scheduled:
+                return False
+            self.flush_scheduled = True
+        set_timeout(self.end_burst, self.QUIET_SECONDS)
+        return False
+
+    def end_burst(self):
+        with self.lock:
+            still_bursting = time.time() - self.last_suppressed < self.QUIET_SECONDS
+        if still_bursting:
+            set_timeout(self.end_burst, self.QUIET_SECONDS)
+            return
+        self.flush()
+
+    def flush(self):
+        """Queues the summary of the current burst without waiting for it
+        to quiet down, for example when unloading."""
+
+        with self.lock:
+            held = sorted(self.held.values(), key=lambda x: x[0]['timestamp'])
+            self.held = {}
+            self.flush_scheduled = False
+            if not held:
+                return
+            self.bursts += 1
+
+        summary = held[-self.capacity():]
+        log(DEBUG, 'Collapsed burst across {0} files into {1} heartbeats ({2} suppressed in {3} bursts so far).'.format(
+            len(held), len(summary), self.suppressed, self.bursts))
+        for heartbeat, session in summary:
+            queue_heartbeat(heartbeat, session)
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def append_heartbeat(entity, timestamp, is_write, view, project, folders, session=None):
+    folder = find_folder_containing_file(folders, entity) if folders else None
     heartbeat = {
         'entity': entity,
         'timestamp': timestamp,
@@ -451,6 +1586,8 @@ def append_heartbeat(entity, timestamp, is_write, view, project, folders):
         'project': project,
         'folders': folders,
         'lines_in_file': view.rowcol(view.size())[0] + 1,
+        'language': view_language(view),
+        'branch': BRANCHES.branch(folder) if folder else None,
     }
     selections = view.sel()
     if selections and len(selections) > 0:
@@ -458,7 +1595,20 @@ def append_heartbeat(entity, timestamp, is_write, view, project, folders):
         row, col = rowcol[0] + 1, rowcol[1] + 1
         heartbeat['lineno'] = row
         heartbeat['cursorpos'] = col
+
+    if RATE_LIMITER.allow(heartbeat, session):
+        queue_heartbeat(heartbeat, session)
+
+
+def queue_heartbeat(heartbeat, session=None):
+    global LAST_HEARTBEAT
+
+    entity, timestamp, is_write = heartbeat['entity'], heartbeat['timestamp'], heartbeat['is_write']
+
+    # add this heartbeat to queue
     HEARTBEATS.put_nowait(heartbeat)
+    TRACE.record_heartbeat(heartbeat)
+    record_local_activity(heartbeat)
 
     # make this heartbeat the LAST_HEARTBEAT
     LAST_HEARTBEAT = {
@@ -466,72 +1616,442 @@ def append_heartbeat(entity, timestamp, is_write, view, project, folders):
         'time': timestamp,
         'is_write': is_write,
     }
+    if session:
+        session.record_heartbeat(entity, timestamp)
 
     # process the queue of heartbeats in the future
     set_timeout(lambda: process_queue(timestamp), SEND_BUFFER_SECONDS)
 
 
+@profiled
 def process_queue(timestamp):
     global LAST_HEARTBEAT_SENT_AT
 
     if not isCliInstalled():
         return
 
+    if IDLE.is_idle():
+        IDLE.defer_flush()
+        return
+
     # Prevent sending heartbeats more often than SEND_BUFFER_SECONDS
     now = int(time.time())
     if timestamp != LAST_HEARTBEAT['time'] and LAST_HEARTBEAT_SENT_AT > now - SEND_BUFFER_SECONDS:
         return
+
+    if HEARTBEATS.empty():
+        return
+
+    # While wakatime-cli is failing or busy, keep heartbeats queued and retry later
+    if not BREAKER.allow():
+        if HEARTBEATS.qsize() >= SPOOL_QUEUE_SIZE:
+            SPOOL.spool_queue()
+        schedule_retry(BREAKER.retry_in())
+        return
+    if not INFLIGHT_SENDS.acquire(False):
+        BREAKER.release_trial()
+        schedule_retry(SEND_BUFFER_SECONDS)
+        return
     LAST_HEARTBEAT_SENT_AT = now
 
     try:
         heartbeat = HEARTBEATS.get_nowait()
     except queue.Empty:
+        INFLIGHT_SENDS.release()
+        BREAKER.release_trial()
         return
 
-    has_extra_heartbeats = False
-    extra_heartbeats = []
+    heartbeats = [heartbeat]
     try:
         while True:
-            extra_heartbeats.append(HEARTBEATS.get_nowait())
-            has_extra_heartbeats = True
+            heartbeats.append(HEARTBEATS.get_nowait())
     except queue.Empty:
         pass
 
-    thread = SendHeartbeatsThread(heartbeat)
-    if has_extra_heartbeats:
-        thread.add_extra_heartbeats(extra_heartbeats)
-    thread.start()
+    get_sender().submit(heartbeats)
+
+
+RETRY_SCHEDULED = False
+
+
+def schedule_retry(seconds):
+    global RETRY_SCHEDULED
+
+    if RETRY_SCHEDULED:
+        return
+    RETRY_SCHEDULED = True
+
+    def retry():
+        global RETRY_SCHEDULED
+        RETRY_SCHEDULED = False
+        process_queue(LAST_HEARTBEAT['time'])
+
+    set_timeout(retry, max(seconds, 1))
+
+
+class CircuitBreaker(object):
+    """Stops running wakatime-cli after repeated failed sends.
+
+    Opens after FAILURE_THRESHOLD consecutive failures, holding heartbeats
+    in the queue. Once the backoff passes, one trial send is let through
+    (half-open). Success closes the breaker, failure re-opens it with
+    double the backoff.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    FAILURE_THRESHOLD = 3
+    BASE_BACKOFF = 30
+    MAX_BACKOFF = 30 * 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = self.BASE_BACKOFF
+        self.open_until = 0
+
+    def is_closed(self):
+        return self.state == self.CLOSED
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() >= self.open_until:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def release_trial(self):
+        """Re-opens a half-open breaker whose trial send didn't start."""
+
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def retry_in(self):
+        if self.state == self.HALF_OPEN:
+            return SEND_BUFFER_SECONDS  # the trial send is still running
+        return max(self.open_until - time.time(), 0)
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                log(INFO, 'wakatime-cli recovered, sending queued heartbeats.')
+            self.state = self.CLOSED
+            self.failures = 0
+            self.backoff = self.BASE_BACKOFF
+
+    def failure(self):
+        """Records a failed send, returning True when the breaker opened."""
+
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.backoff = min(self.backoff * 2, self.MAX_BACKOFF)
+            elif self.failures < self.FAILURE_THRESHOLD:
+                return False
+            self.state = self.OPEN
+            self.open_until = time.time() + self.backoff
+            log(WARNING, 'wakatime-cli failed {0} times, pausing for {1} seconds.'.format(self.failures, self.backoff))
+        retry = '{0} secs'.format(self.backoff) if self.backoff < 60 else format_duration(self.backoff)
+        update_status_bar('Error (retrying in {0})'.format(retry))
+        return True
+
+
+BREAKER = CircuitBreaker()
+INFLIGHT_SENDS = threading.BoundedSemaphore(MAX_INFLIGHT_SENDS)
+
+
+BATCH_VERSION = 2
+BATCH_DICTIONARY_FIELDS = ('entity', 'project', 'folders', 'language', 'branch')
+BATCH_VERSION_DICTIONARY_FIELDS = {
+    1: ('entity', 'project', 'folders', 'language'),
+    2: BATCH_DICTIONARY_FIELDS,
+}
+BATCH_VALUE_FIELDS = ('is_write', 'lines_in_file', 'lineno', 'cursorpos')
+
+
+def encode_heartbeats(heartbeats, compress=True):
+    """Returns heartbeats as a compact batch.
+
+    Entities, projects, folders, languages and branches are written once
+    each in dictionaries and referenced by index, timestamps are deltas in
+    microseconds from the previous heartbeat, and the result is zlib
+    compressed when compress is True and zlib is available.
+    """
+
+    dictionaries = dict((field, []) for field in BATCH_DICTIONARY_FIELDS)
+    indexes = dict((field, {}) for field in BATCH_DICTIONARY_FIELDS)
+    rows = []
+    start = previous = int(round(heartbeats[0]['timestamp'] * 1000000)) if heartbeats else 0
+    for heartbeat in heartbeats:
+        timestamp = int(round(heartbeat['timestamp'] * 1000000))
+        row = [timestamp - previous]
+        previous = timestamp
+        for field in BATCH_DICTIONARY_FIELDS:
+            value = heartbeat.get(field)
+            key = tuple(value) if isinstance(value, list) else value
+            index = indexes[field].get(key)
+            if index is None:
+                index = indexes[field][key] = len(dictionaries[field])
+                dictionaries[field].append(value)
+            row.append(index)
+        row.extend(heartbeat.get(field) for field in BATCH_VALUE_FIELDS)
+        rows.append(row)
+
+    batch = {'v': BATCH_VERSION, 'start': start, 'rows': rows}
+    batch.update(dictionaries)
+    data = json.dumps(batch, separators=(',', ':')).encode('utf-8')
+    if compress and zlib is not None:
+        data = zlib.compress(data)
+    return data
+
+
+def decode_heartbeats(data):
+    """Returns the heartbeats in a batch from encode_heartbeats, as the
+    dicts queued by append_heartbeat."""
+
+    if data[:1] != b'{':
+        data = zlib.decompress(data)
+    batch = json.loads(data.decode('utf-8'))
+    dictionary_fields = BATCH_VERSION_DICTIONARY_FIELDS.get(batch.get('v'))
+    if dictionary_fields is None:
+        raise ValueError('Unsupported heartbeat batch version: {0}'.format(batch.get('v')))
+
+    heartbeats = []
+    timestamp = batch['start']
+    fields = len(dictionary_fields)
+    for row in batch['rows']:
+        timestamp += row[0]
+        heartbeat = {'timestamp': timestamp / 1000000.0}
+        for num, field in enumerate(dictionary_fields):
+            heartbeat[field] = batch[field][row[num + 1]]
+        for num, field in enumerate(BATCH_VALUE_FIELDS):
+            heartbeat[field] = row[fields + num + 1]
+        heartbeats.append(heartbeat)
+    return heartbeats
+
+
+class HeartbeatSpool(object):
+    """Keeps unsent heartbeats on disk as encoded batches, so they survive
+    restarting Sublime and don't pile up in memory while wakatime-cli is
+    failing.
+
+    Each spooled batch is its own file. A process claims a file by renaming
+    it before reading, so batches are only requeued once when several
+    Sublime processes restore at the same time.
+    """
+
+    SUFFIX = '.batch'
+
+    def folder(self):
+        return os.path.join(RESOURCES_FOLDER, 'sublime-spool')
+
+    def files(self):
+        try:
+            names = os.listdir(self.folder())
+        except OSError:
+            return []
+        return sorted(os.path.join(self.folder(), name) for name in names if name.endswith(self.SUFFIX))
+
+    def pending(self):
+        return len(self.files()) > 0
+
+    def spool(self, heartbeats):
+        if not heartbeats:
+            return
+        try:
+            if not os.path.exists(self.folder()):
+                os.makedirs(self.folder())
+            path = os.path.join(self.folder(), '{0:.6f}-{1}{2}'.format(time.time(), os.getpid(), self.SUFFIX))
+            tmp_file = '{0}.tmp'.format(path)
+            try:
+                with open(tmp_file, 'wb') as fh:
+                    fh.write(encode_heartbeats(heartbeats))
+                replaceFile(tmp_file, path)
+            finally:
+                removeFile(tmp_file)
+            log(DEBUG, 'Spooled {0} heartbeats to {1}'.format(len(heartbeats), path))
+        except:
+            log(WARNING, 'Unable to spool {0} heartbeats: {1}'.format(len(heartbeats), u(sys.exc_info()[1])))
+
+    def spool_queue(self):
+        """Moves all queued heartbeats to disk."""
+
+        heartbeats = []
+        try:
+            while True:
+                heartbeats.append(HEARTBEATS.get_nowait())
+        except queue.Empty:
+            pass
+        self.spool(heartbeats)
+
+    def restore(self):
+        """Puts spooled heartbeats back on the queue."""
+
+        count = 0
+        for path in self.files():
+            claimed = '{0}.{1}.claimed'.format(path, os.getpid())
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # restored by another Sublime process
+            try:
+                with open(claimed, 'rb') as fh:
+                    heartbeats = decode_heartbeats(fh.read())
+                for heartbeat in heartbeats:
+                    HEARTBEATS.put_nowait(heartbeat)
+                count += len(heartbeats)
+            except:
+                log(WARNING, 'Unable to restore spooled heartbeats from {0}: {1}'.format(path, u(sys.exc_info()[1])))
+            finally:
+                removeFile(claimed)
+        if count:
+            log(DEBUG, 'Restored {0} spooled heartbeats'.format(count))
+            schedule_retry(SEND_BUFFER_SECONDS)
+
+
+SPOOL = HeartbeatSpool()
 
 
 class SendHeartbeatsThread(threading.Thread):
     """Non-blocking thread for sending heartbeats to api.
     """
 
-    def __init__(self, heartbeat):
+    def __init__(self, sender, heartbeats):
         threading.Thread.__init__(self)
+        self.sender = sender
+        self.heartbeats = heartbeats
 
-        self.debug = SETTINGS.get('debug')
-        self.api_key = APIKEY.read() or ''
-        self.ignore = SETTINGS.get('ignore', [])
-        self.include = SETTINGS.get('include', [])
-        self.hidefilenames = SETTINGS.get('hidefilenames')
-        self.proxy = SETTINGS.get('proxy')
+    def run(self):
+        """Running in background thread."""
 
-        self.heartbeat = heartbeat
-        self.has_extra_heartbeats = False
+        try:
+            deliver(self.sender, self.heartbeats)
+        finally:
+            INFLIGHT_SENDS.release()
 
-    def add_extra_heartbeats(self, extra_heartbeats):
-        self.has_extra_heartbeats = True
-        self.extra_heartbeats = extra_heartbeats
 
-    def run(self):
-        """Running in background thread."""
+@profiled
+def deliver(sender, heartbeats):
+    """Sends heartbeats with the sender, updating the circuit breaker and
+    status bar with the result."""
+
+    try:
+        result = sender.send(heartbeats)
+    except:
+        # timed out, or wakatime-cli could not be started
+        log(ERROR, u(sys.exc_info()[1]))
+        result = SEND_RETRY
+
+    if result == SEND_ACCEPTED:
+        BREAKER.success()
+        update_status_bar('OK')
+        if SPOOL.pending() and not PLUGIN_UNLOADED:
+            SPOOL.restore()
+    elif result == SEND_RETRY:
+        requeue(heartbeats)
+        if not BREAKER.failure():
+            update_status_bar('Error')
+    else:
+        log(ERROR, 'Dropped {0} heartbeats rejected by wakatime-cli.'.format(len(heartbeats)))
+        update_status_bar('Error')
+
+
+def requeue(heartbeats):
+    """Puts heartbeats back on the queue when wakatime-cli didn't save
+    them, to be held while the circuit breaker is open."""
+
+    if PLUGIN_UNLOADED:
+        # a send which finished after unloading, nothing would flush the queue
+        SPOOL.spool(heartbeats)
+        return
+    for heartbeat in heartbeats:
+        HEARTBEATS.put_nowait(heartbeat)
+    schedule_retry(SEND_BUFFER_SECONDS)
+
 
-        self.send_heartbeats()
+class HeartbeatSender(object):
+    """Base class for ways of sending queued heartbeats.
+
+    Subclasses implement send_batch, returning SEND_ACCEPTED, SEND_RETRY
+    or SEND_FAILED. Every batch is timed for throughput and latency stats.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.heartbeats = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.max_latency = 0.0
+
+    def submit(self, heartbeats):
+        """Sends the heartbeats in the background. Called holding one of the
+        INFLIGHT_SENDS slots, which must be released when done."""
+
+        SendHeartbeatsThread(self, heartbeats).start()
+
+    def stop(self):
+        """Stops any background work, when unloading or switching senders."""
+
+    def send(self, heartbeats):
+        # not time.time, which the replay script swaps for a virtual clock
+        start = default_timer()
+        result = SEND_RETRY
+        try:
+            result = self.send_batch(heartbeats)
+            return result
+        finally:
+            latency = default_timer() - start
+            with self.lock:
+                self.batches += 1
+                self.heartbeats += len(heartbeats)
+                self.failures += 0 if result == SEND_ACCEPTED else 1
+                self.busy_seconds += latency
+                self.max_latency = max(self.max_latency, latency)
+            log(DEBUG, 'Sent {count} heartbeats via {name} in {ms:.0f}ms ({stats}).'.format(
+                count=len(heartbeats),
+                name=self.name,
+                ms=latency * 1000,
+                stats=self.format_stats(),
+            ))
+
+    def send_batch(self, heartbeats):
+        raise NotImplementedError
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': self.name,
+                'batches': self.batches,
+                'heartbeats': self.heartbeats,
+                'failures': self.failures,
+                'avg_latency_ms': self.busy_seconds * 1000 / self.batches if self.batches else 0,
+                'max_latency_ms': self.max_latency * 1000,
+                'heartbeats_per_second': self.heartbeats / self.busy_seconds if self.busy_seconds else 0,
+            }
+
+    def format_stats(self):
+        stats = self.stats()
+        return '{batches} batches, avg {avg_latency_ms:.0f}ms, max {max_latency_ms:.0f}ms, {heartbeats_per_second:.1f} heartbeats/s'.format(**stats)
+
+
+class CliSender(HeartbeatSender):
+    """Runs wakatime-cli once per batch, passing all but the first
+    heartbeat on stdin as extra heartbeats."""
+
+    name = 'cli'
 
     def build_heartbeat(self, entity=None, timestamp=None, is_write=None,
                         lineno=None, cursorpos=None, lines_in_file=None,
-                        project=None, folders=None):
+                        project=None, folders=None, language=None,
+                        branch=None):
         """Returns a dict for passing to wakatime-cli as arguments."""
 
         heartbeat = {
@@ -540,12 +2060,14 @@ class SendHeartbeatsThread(threading.Thread):
             'is_write': is_write,
         }
 
-        if project and project.get('name'):
-            heartbeat['alternate_project'] = project.get('name')
-        elif folders:
-            project_name = find_project_from_folders(folders, entity)
-            if project_name:
-                heartbeat['alternate_project'] = project_name
+        project_name = heartbeat_project_name(entity, project, folders)
+        if project_name:
+            heartbeat['alternate_project'] = project_name
+
+        if branch:
+            heartbeat['alternate_branch'] = branch
+        if language:
+            heartbeat['alternate_language'] = language
 
         if lineno is not None:
             heartbeat['lineno'] = lineno
@@ -556,8 +2078,11 @@ class SendHeartbeatsThread(threading.Thread):
 
         return heartbeat
 
-    def send_heartbeats(self):
-        heartbeat = self.build_heartbeat(**self.heartbeat)
+    def build_command(self, heartbeats):
+        """Returns the wakatime-cli command and stdin for a batch."""
+
+        heartbeat = self.build_heartbeat(**heartbeats[0])
+        api_key = APIKEY.read() or ''
         ua = 'sublime/%d sublime-wakatime/%s' % (ST_VERSION, __version__)
         cmd = [
             getCliLocation(),
@@ -565,57 +2090,168 @@ class SendHeartbeatsThread(threading.Thread):
             '--time', str('%f' % heartbeat['timestamp']),
             '--plugin', ua,
         ]
-        if self.api_key:
-            cmd.extend(['--key', str(bytes.decode(self.api_key.encode('utf8')))])
+        if api_key:
+            cmd.extend(['--key', str(bytes.decode(api_key.encode('utf8')))])
         if heartbeat['is_write']:
             cmd.append('--write')
         if heartbeat.get('alternate_project'):
             cmd.extend(['--alternate-project', heartbeat['alternate_project']])
+        if heartbeat.get('alternate_branch'):
+            cmd.extend(['--alternate-branch', heartbeat['alternate_branch']])
+        if heartbeat.get('alternate_language'):
+            cmd.extend(['--alternate-language', heartbeat['alternate_language']])
         if heartbeat.get('lineno') is not None:
             cmd.extend(['--lineno', '{0}'.format(heartbeat['lineno'])])
         if heartbeat.get('cursorpos') is not None:
             cmd.extend(['--cursorpos', '{0}'.format(heartbeat['cursorpos'])])
         if heartbeat.get('lines') is not None:
             cmd.extend(['--lines-in-file', '{0}'.format(heartbeat['lines'])])
-        for pattern in self.ignore:
+        for pattern in SETTINGS.get('ignore', []):
             cmd.extend(['--exclude', pattern])
-        for pattern in self.include:
+        for pattern in SETTINGS.get('include', []):
             cmd.extend(['--include', pattern])
-        if self.debug:
+        if SETTINGS.get('debug'):
             cmd.append('--verbose')
-        if self.hidefilenames:
+        if SETTINGS.get('hidefilenames'):
             cmd.append('--hidefilenames')
-        if self.proxy:
-            cmd.extend(['--proxy', self.proxy])
-        if self.has_extra_heartbeats:
+        if SETTINGS.get('proxy'):
+            cmd.extend(['--proxy', SETTINGS.get('proxy')])
+
+        inp = None
+        if len(heartbeats) > 1:
             cmd.append('--extra-heartbeats')
-            stdin = PIPE
-            extra_heartbeats = json.dumps([self.build_heartbeat(**x) for x in self.extra_heartbeats])
+            extra_heartbeats = json.dumps([self.build_heartbeat(**x) for x in heartbeats[1:]])
             inp = "{0}\n".format(extra_heartbeats).encode('utf-8')
-        else:
-            extra_heartbeats = None
-            stdin = None
-            inp = None
 
+        return cmd, inp
+
+    def send_batch(self, heartbeats):
+        cmd, inp = self.build_command(heartbeats)
         log(DEBUG, ' '.join(obfuscate_apikey(cmd)))
+        process = Popen(cmd, stdin=PIPE if inp else None, stdout=PIPE, stderr=STDOUT)
+        output, _err = communicate(process, inp)
+        retcode = process.poll()
+        if retcode:
+            log(DEBUG if retcode == 102 or retcode == 112 else ERROR, 'wakatime-core exited with status: {0}'.format(retcode))
+        if output:
+            log(ERROR, u('wakatime-core output: {0}').format(output))
+        # exit codes 102 and 112 mean wakatime-cli saved them offline
+        if not retcode or retcode == 102 or retcode == 112:
+            return SEND_ACCEPTED
+        # killed by a signal, not by rejecting the heartbeats
+        if retcode < 0:
+            return SEND_RETRY
+        return SEND_FAILED
+
+
+class PersistentCliSender(CliSender):
+    """Sends from one long-lived worker thread instead of a thread per
+    flush. Batches submitted while wakatime-cli is running are combined
+    into the next invocation.
+
+    wakatime-cli has no long-running mode, so each batch is still its own
+    process.
+    """
+
+    name = 'persistent_cli'
+
+    def __init__(self):
+        CliSender.__init__(self)
+        self.pending = queue.Queue()
+        self.worker = None
+
+    def submit(self, heartbeats):
+        self.pending.put_nowait(heartbeats)
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.work)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def stop(self):
+        """Stops the worker, requeueing batches it hasn't started."""
+
         try:
-            process = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=STDOUT)
-            output, _err = process.communicate(input=inp)
-            retcode = process.poll()
-            if (not retcode or retcode == 102 or retcode == 112) and not output:
-                self.sent()
-            else:
-                update_status_bar('Error')
-            if retcode:
-                log(DEBUG if retcode == 102 or retcode == 112 else ERROR, 'wakatime-core exited with status: {0}'.format(retcode))
-            if output:
-                log(ERROR, u('wakatime-core output: {0}').format(output))
-        except:
-            log(ERROR, u(sys.exc_info()[1]))
-            update_status_bar('Error')
+            while True:
+                batch = self.pending.get_nowait()
+                if batch is None:
+                    continue
+                for heartbeat in batch:
+                    HEARTBEATS.put_nowait(heartbeat)
+                INFLIGHT_SENDS.release()
+        except queue.Empty:
+            pass
+        if self.worker is not None and self.worker.is_alive():
+            self.pending.put_nowait(None)
+        self.worker = None
 
-    def sent(self):
-        update_status_bar('OK')
+    def work(self):
+        while True:
+            batch = self.pending.get()
+            if batch is None:
+                return
+            batches = [batch]
+            stopping = False
+            try:
+                while not stopping:
+                    batch = self.pending.get_nowait()
+                    if batch is None:
+                        stopping = True
+                    else:
+                        batches.append(batch)
+            except queue.Empty:
+                pass
+            try:
+                deliver(self, [heartbeat for batch in batches for heartbeat in batch])
+            finally:
+                for _batch in batches:
+                    INFLIGHT_SENDS.release()
+            if stopping:
+                return
+
+
+class MemorySender(HeartbeatSender):
+    """Records batches in memory instead of sending them, for testing and
+    benchmarking. Sends synchronously, so results are deterministic.
+
+    Not a sender_backend choice, since nothing it records reaches WakaTime.
+    Scripts install it by replacing get_sender.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        HeartbeatSender.__init__(self)
+        self.sent = []
+
+    def submit(self, heartbeats):
+        try:
+            deliver(self, heartbeats)
+        finally:
+            INFLIGHT_SENDS.release()
+
+    def send_batch(self, heartbeats):
+        self.sent.append((time.time(), list(heartbeats)))
+        return SEND_ACCEPTED
+
+
+SENDERS = dict((cls.name, cls) for cls in (CliSender, PersistentCliSender))
+SENDER = None
+
+
+def get_sender():
+    """Returns the sender for the sender_backend setting."""
+
+    global SENDER
+
+    name = SETTINGS.get('sender_backend') or CliSender.name
+    if name not in SENDERS:
+        log(WARNING, 'Unknown sender_backend {0}, using {1}.'.format(name, CliSender.name))
+        name = CliSender.name
+    if SENDER is None or SENDER.name != name:
+        if SENDER is not None:
+            SENDER.stop()
+        SENDER = SENDERS[name]()
+    return SENDER
 
 
 def plugin_loaded():
@@ -625,11 +2261,28 @@ def plugin_loaded():
     log(INFO, 'Initializing WakaTime plugin v%s' % __version__)
     update_status_bar('Initializing...')
 
-    UpdateCLI().start()
+    LEADER.start()
+    if not LEADER.is_leader() and not isCliInstalled():
+        UpdateCLI().start()
+
+    set_timeout(DURATIONS.load, 0)
+    set_timeout(SPOOL.restore, 0)
 
     after_loaded()
 
 
+def plugin_unloaded():
+    global PLUGIN_UNLOADED
+    PLUGIN_UNLOADED = True
+
+    LEADER.stop()
+    RATE_LIMITER.flush()
+    DURATIONS.checkpoint()
+    if SENDER is not None:
+        SENDER.stop()
+    SPOOL.spool_queue()
+
+
 def after_loaded():
     if not prompt_api_key():
         set_timeout(after_loaded, 0.5)
@@ -643,16 +2296,47 @@ if ST_VERSION < 3000:
 
 class WakatimeListener(sublime_plugin.EventListener):
 
+    @profiled
     def on_post_save(self, view):
-        handle_activity(view, is_write=True)
+        window = view.window()
+        if window is not None and hasattr(window, 'project_file_name') and view.file_name() == window.project_file_name():
+            get_window_session(window).invalidate_project()
+        handle_activity(view, is_write=True, kind='save')
+        IDLE.touch()
 
+    @profiled
     def on_selection_modified(self, view):
         if is_view_active(view):
-            handle_activity(view)
+            handle_activity(view, kind='selection')
+            IDLE.touch()
 
+    @profiled
     def on_modified(self, view):
         if is_view_active(view):
             handle_activity(view)
+            IDLE.touch()
+
+    @profiled
+    def on_activated(self, view):
+        IDLE.activated()
+        TRACE.record_event('activated', time.time(), view, view.window())
+
+    @profiled
+    def on_deactivated(self, view):
+        IDLE.deactivated()
+        TRACE.record_event('deactivated', time.time(), view, view.window())
+
+    @profiled
+    def on_load_project(self, window):
+        get_window_session(window).invalidate_project()
+
+    @profiled
+    def on_post_save_project(self, window):
+        get_window_session(window).invalidate_project()
+
+    @profiled
+    def on_pre_close_window(self, window):
+        close_window_session(window)
 
 
 class WakatimeDashboardCommand(sublime_plugin.ApplicationCommand):
@@ -661,51 +2345,334 @@ class WakatimeDashboardCommand(sublime_plugin.ApplicationCommand):
         webbrowser.open_new_tab('https://wakatime.com/dashboard')
 
 
+class WakatimeStartProfilingCommand(sublime_plugin.ApplicationCommand):
+    """Starts profiling the plugin's listeners and background threads."""
+
+    def run(self):
+        PROFILER.start()
+        sublime.status_message('WakaTime: profiling started')
+
+    def is_enabled(self):
+        return PROFILER.available() and not PROFILER.active()
+
+
+class WakatimeMemorySnapshotCommand(sublime_plugin.ApplicationCommand):
+    """Takes a tracemalloc snapshot while profiling."""
+
+    def run(self):
+        PROFILER.snapshot()
+        sublime.status_message('WakaTime: memory snapshot taken')
+
+    def is_enabled(self):
+        return PROFILER.tracing_memory()
+
+
+class WakatimeStopProfilingCommand(sublime_plugin.ApplicationCommand):
+    """Stops profiling and opens the summary."""
+
+    def run(self):
+        summary = PROFILER.stop()
+        window = sublime.active_window()
+        if summary and window is not None:
+            window.open_file(summary)
+
+    def is_enabled(self):
+        return PROFILER.active()
+
+
+class WakatimeLocalSummaryCommand(sublime_plugin.WindowCommand):
+    """Shows today's coding time computed locally, without wakatime-cli."""
+
+    def run(self):
+        set_timeout(self.show, 0)
+
+    def show(self):
+        DURATIONS.refresh()
+        items = [['Today', format_duration(DURATIONS.today_seconds())]]
+        for group, title in (('project', 'Project'), ('language', 'Language'), ('entity', 'File')):
+            for name, seconds in DURATIONS.summary(group):
+                items.append(['{0}: {1}'.format(title, name), format_duration(seconds)])
+        self.window.show_quick_panel(items, None)
+
+
 class UpdateCLI(threading.Thread):
     """Non-blocking thread for downloading latest wakatime-cli from GitHub.
+
+    Installs are serialized across Sublime processes with a lock file. The
+    download is verified against the release's SHA-256 checksums before
+    replacing the current binary.
     """
 
     def run(self):
         if isCliLatest():
             return
 
+        if not os.path.exists(RESOURCES_FOLDER):
+            os.makedirs(RESOURCES_FOLDER)
+
+        lock = LockFile(os.path.join(RESOURCES_FOLDER, 'wakatime-cli.lock'), stale_seconds=INSTALL_LOCK_TIMEOUT)
+        if not lock.acquire(timeout=INSTALL_LOCK_TIMEOUT):
+            log(WARNING, 'Timed out waiting for another process to finish installing wakatime-cli.')
+            return
+        lock.keep_alive(INSTALL_LOCK_TIMEOUT / 3.0)
+
+        try:
+            # another Sublime process may have finished installing while we waited
+            if isCliLatest():
+                return
+            self.install()
+        except:
+            log(DEBUG, traceback.format_exc())
+        finally:
+            lock.release()
+
+    def install(self):
         log(INFO, 'Downloading wakatime-cli...')
 
         if os.path.isdir(os.path.join(RESOURCES_FOLDER, 'wakatime-cli')):
             shutil.rmtree(os.path.join(RESOURCES_FOLDER, 'wakatime-cli'))
 
-        if not os.path.exists(RESOURCES_FOLDER):
-            os.makedirs(RESOURCES_FOLDER)
+        zip_file = os.path.join(RESOURCES_FOLDER, 'wakatime-cli.zip')
 
-        try:
-            url = cliDownloadUrl()
-            log(DEBUG, 'Downloading wakatime-cli from {url}'.format(url=url))
-            zip_file = os.path.join(RESOURCES_FOLDER, 'wakatime-cli.zip')
+        # when the latest version isn't known yet, fetch the release metadata
+        # while downloading from GitHub's latest release redirect
+        version = LATEST_CLI_VERSION
+        url = cliDownloadUrl(version)
+        checksums = BackgroundCall(lambda: getCliChecksums(version or getLatestCliVersion()))
+        checksums.start()
+
+        log(DEBUG, 'Downloading wakatime-cli from {url}'.format(url=url))
+        download(url, zip_file)
+
+        checksums = checksums.result() or {}
+        expected = checksums.get(os.path.basename(url))
+        if expected and sha256sum(zip_file) != expected and not version and LATEST_CLI_VERSION:
+            # a new release was published between the metadata fetch and the download
+            url = cliDownloadUrl(LATEST_CLI_VERSION)
+            log(DEBUG, 'Checksum mismatch, downloading wakatime-cli from {url}'.format(url=url))
             download(url, zip_file)
 
-            if isCliInstalled():
-                try:
-                    os.remove(getCliLocation())
-                except:
-                    log(DEBUG, traceback.format_exc())
+        if expected is None:
+            log(ERROR, 'Checksum not found for {url}, not installing wakatime-cli.'.format(url=url))
+            removeFile(zip_file)
+            return
+        if sha256sum(zip_file) != expected:
+            log(ERROR, 'Checksum mismatch for {url}, not installing wakatime-cli.'.format(url=url))
+            removeFile(zip_file)
+            return
 
-            log(INFO, 'Extracting wakatime-cli...')
+        log(INFO, 'Extracting wakatime-cli...')
+        staging = tempfile.mkdtemp(prefix='.wakatime-cli-', dir=RESOURCES_FOLDER)
+        try:
             with ZipFile(zip_file) as zf:
-                zf.extractall(RESOURCES_FOLDER)
-
+                zf.extractall(staging)
+            staged = os.path.join(staging, os.path.basename(getCliLocation()))
             if not is_win:
-                os.chmod(getCliLocation(), 509)  # 755
+                os.chmod(staged, 509)  # 755
+            replaceFile(staged, getCliLocation())
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+            removeFile(zip_file)
+
+        createSymlink()
+
+        log(INFO, 'Finished extracting wakatime-cli.')
 
+
+class BackgroundCall(threading.Thread):
+    """Runs a function in a background thread, keeping its return value."""
+
+    def __init__(self, func):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.value = None
+
+    def run(self):
+        try:
+            self.value = self.func()
+        except:
+            log(DEBUG, traceback.format_exc())
+
+    def result(self):
+        self.join()
+        return self.value
+
+
+class LockFile(object):
+    """Cross-process lock held by exclusively creating a file.
+
+    Locks older than stale_seconds are assumed to be left behind by a
+    crashed process and are taken over.
+    """
+
+    def __init__(self, path, stale_seconds=300):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self.token = '{pid}-{id}'.format(pid=os.getpid(), id=id(self))
+        self.locked = False
+        self.released = threading.Event()
+
+    def acquire(self, timeout=0):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            if self.try_acquire():
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+
+    def try_acquire(self, takeover=True):
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if takeover and self.is_stale() and self.take_over():
+                return self.try_acquire(takeover=False)
+            return False
+        try:
+            os.write(fd, self.token.encode('utf-8'))
+        finally:
+            os.close(fd)
+        self.locked = True
+        self.released.clear()
+        return True
+
+    def take_over(self):
+        """Moves a stale lock file aside, returning True when it was stale.
+
+        Renaming is atomic, so only one process moves a given lock file. A
+        process which saw the lock go stale just as another replaced it may
+        move the new lock instead, so the moved file is checked again and
+        put back when it's live.
+        """
+
+        moved = '{0}.{1}.stale'.format(self.path, self.token)
+        try:
+            os.rename(self.path, moved)
+        except OSError:
+            return False  # moved by another process
+        try:
+            if os.path.getmtime(moved) < time.time() - self.stale_seconds:
+                log(DEBUG, 'Removed stale lock file {0}'.format(self.path))
+                return True
             try:
-                os.remove(os.path.join(RESOURCES_FOLDER, 'wakatime-cli.zip'))
-            except:
-                log(DEBUG, traceback.format_exc())
+                os.link(moved, self.path)  # fails if a new lock was created since
+            except AttributeError:  # py2 on Windows
+                if not os.path.exists(self.path):
+                    os.rename(moved, self.path)
+            except OSError:
+                pass
+            return False
+        finally:
+            removeFile(moved)
+
+    def is_stale(self):
+        try:
+            return os.path.getmtime(self.path) < time.time() - self.stale_seconds
+        except OSError:
+            return False
+
+    def is_owner(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                return fh.read() == self.token
+        except IOError:
+            return False
+
+    def touch(self):
+        try:
+            os.utime(self.path, None)
+        except OSError:
+            pass
+
+    def keep_alive(self, interval):
+        """Touches the lock every interval seconds until it's released, so
+        slow work while holding it isn't mistaken for a crashed process."""
+
+        def refresh():
+            while not self.released.wait(interval):
+                self.touch()
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def release(self):
+        if self.locked and self.is_owner():
+            removeFile(self.path)
+        self.locked = False
+        self.released.set()
+
+
+class LeaderElection(object):
+    """Elects one Sublime process as leader with a lock file under
+    RESOURCES_FOLDER.
+
+    The leader renews its lease every LEADER_RENEW_SECONDS. It owns
+    wakatime-cli update checks, and on each renewal refreshes today's
+    coding time and publishes it while other processes ask for it. Those
+    only read what it published. If the leader stops renewing, for example
+    because it crashed, the next process to look takes over.
+    """
+
+    def __init__(self):
+        self.lock = LockFile(os.path.join(RESOURCES_FOLDER, 'sublime-leader.lock'), stale_seconds=LEADER_LEASE_SECONDS)
+        self.running = False
+
+    def is_leader(self):
+        try:
+            if self.lock.locked and not self.lock.is_owner():
+                log(DEBUG, 'Lost leadership to another Sublime process.')
+                self.lock.locked = False
+            if not self.lock.locked:
+                if not os.path.exists(RESOURCES_FOLDER):
+                    os.makedirs(RESOURCES_FOLDER)
+                self.lock.try_acquire()
         except:
             log(DEBUG, traceback.format_exc())
+            return False
+        return self.lock.locked
 
-        createSymlink()
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.renew()
 
-        log(INFO, 'Finished extracting wakatime-cli.')
+    def renew(self):
+        if not self.running:
+            return
+        was_leader = self.lock.locked
+        if self.is_leader():
+            self.lock.touch()
+            if not was_leader:
+                self.elected()
+            self.refresh_today()
+        set_timeout(self.renew, LEADER_RENEW_SECONDS)
+
+    def refresh_today(self):
+        """Fetches and publishes today's coding time while other processes
+        are asking for it, since they don't run wakatime-cli themselves."""
+
+        if not SETTINGS.get('status_bar_enabled') or not SETTINGS.get('status_bar_coding_activity'):
+            return
+        if not shared_today_requested() or not BREAKER.is_closed():
+            return
+        if read_shared_today(max_age=FETCH_TODAY_DEBOUNCE_SECONDS):
+            return
+        FetchStatusBarCodingTime().start()
+
+    def elected(self):
+        log(DEBUG, 'This Sublime process is now the WakaTime leader.')
+        UpdateCLI().start()
+
+    def stop(self):
+        self.running = False
+        self.lock.release()
+
+
+LEADER = LeaderElection()
 
 
 def getCliLocation():
@@ -743,7 +2710,7 @@ def isCliLatest():
 
     args = [getCliLocation(), '--version']
     try:
-        stdout, stderr = Popen(args, stdout=PIPE, stderr=PIPE).communicate()
+        stdout, stderr = communicate(Popen(args, stdout=PIPE, stderr=PIPE))
     except:
         return False
     stdout = (stdout or b'') + (stderr or b'')
@@ -802,8 +2769,10 @@ def getLatestCliVersion():
                 configs.add_section('internal')
             configs.set('internal', 'cli_version', ver)
             configs.set('internal', 'cli_version_last_modified', last_modified)
-            with open(INTERNAL_CONFIG_FILE, 'w', encoding='utf-8') as fh:
+            tmp_file = '{0}.{1}.tmp'.format(INTERNAL_CONFIG_FILE, os.getpid())
+            with open(tmp_file, 'w', encoding='utf-8') as fh:
                 configs.write(fh)
+            replaceFile(tmp_file, INTERNAL_CONFIG_FILE)
 
         LATEST_CLI_VERSION = ver
         return ver
@@ -831,7 +2800,7 @@ def extractVersion(text):
     return None
 
 
-def cliDownloadUrl():
+def cliDownloadUrl(version=None):
     osname = platform.system().lower()
     arch = architecture()
 
@@ -860,7 +2829,12 @@ def cliDownloadUrl():
     if check not in validCombinations:
         reportMissingPlatformSupport(osname, arch)
 
-    version = getLatestCliVersion()
+    if not version:
+        return '{prefix}/wakatime-cli-{osname}-{arch}.zip'.format(
+            prefix=GITHUB_LATEST_DOWNLOAD_PREFIX,
+            osname=osname,
+            arch=arch,
+        )
 
     return '{prefix}/{version}/wakatime-cli-{osname}-{arch}.zip'.format(
         prefix=GITHUB_DOWNLOAD_PREFIX,
@@ -870,6 +2844,34 @@ def cliDownloadUrl():
     )
 
 
+def getCliChecksums(version):
+    """Returns dict of file name to SHA-256 from a release's checksums.txt,
+    from the latest release when version is unknown."""
+
+    if version:
+        url = '{prefix}/{version}/checksums.txt'.format(prefix=GITHUB_DOWNLOAD_PREFIX, version=version)
+    else:
+        url = '{prefix}/checksums.txt'.format(prefix=GITHUB_LATEST_DOWNLOAD_PREFIX)
+    headers, contents, code = request(url)
+    if code != 200 or not contents:
+        return None
+
+    checksums = {}
+    for line in contents.decode('utf-8').splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            checksums[parts[1]] = parts[0].lower()
+    return checksums
+
+
+def sha256sum(filePath):
+    sha = hashlib.sha256()
+    with open(filePath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
 def reportMissingPlatformSupport(osname, arch):
     url = 'https://api.wakatime.com/api/v1/cli-missing?osname={osname}&architecture={arch}&plugin=sublime'.format(
         osname=osname,
@@ -975,26 +2977,65 @@ def download(url, filePath):
 
 def is_symlink(path):
     try:
-        return os.is_symlink(path)
+        return os.path.islink(path)
     except:
         return False
 
 
+def removeFile(filePath):
+    try:
+        os.remove(filePath)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log(DEBUG, traceback.format_exc())
+
+
+def replaceFile(src, dst):
+    """Atomically moves src to dst, replacing dst if it exists."""
+
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # py2
+        if is_win and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def writeFileAtomic(filePath, contents):
+    """Writes contents to a temp file, then renames it over filePath so
+    other Sublime processes never read a partially written file."""
+
+    tmp_file = '{0}.{1}.tmp'.format(filePath, os.getpid())
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as fh:
+            fh.write(u(contents))
+        replaceFile(tmp_file, filePath)
+    finally:
+        removeFile(tmp_file)
+
+
 def createSymlink():
     link = os.path.join(RESOURCES_FOLDER, 'wakatime-cli')
     if is_win:
         link = link + '.exe'
-    elif os.path.exists(link) and is_symlink(link):
-        return  # don't re-create symlink on Unix-like platforms
+    elif is_symlink(link) and os.readlink(link) == getCliLocation():
+        return  # symlink is already pointing to the current binary
 
+    # build the new link beside the old one, then swap it into place
+    tmp_link = '{link}.{pid}.tmp'.format(link=link, pid=os.getpid())
+    removeFile(tmp_link)
     try:
-        os.symlink(getCliLocation(), link)
+        os.symlink(getCliLocation(), tmp_link)
+        replaceFile(tmp_link, link)
     except:
+        removeFile(tmp_link)
         try:
-            shutil.copy2(getCliLocation(), link)
+            shutil.copy2(getCliLocation(), tmp_link)
             if not is_win:
-                os.chmod(link, 509)  # 755
+                os.chmod(tmp_link, 509)  # 755
+            replaceFile(tmp_link, link)
         except:
+            removeFile(tmp_link)
             log(WARNING, traceback.format_exc())
 
 
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" ==========================================================
+File:        bench_project_data.py
+Description: Measures memory used by project data while queueing
+             heartbeats for a window with a large .sublime-project file.
+Maintainer:  WakaTime <support@wakatime.com>
+License:     BSD, see LICENSE for more details.
+Website:     https://wakatime.com/
+===========================================================
+
+Compares reading window.project_data() on every heartbeat and keeping it
+in the queue, like older plugin versions did, with the plugin's cached
+project name:
+
+    python scripts/bench_project_data.py --size-mb 4 --heartbeats 200
+"""
+
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from replay_trace import Clock, FakeSublime, Settings, View, Window, default_settings, load_plugin  # noqa: E402
+
+
+def large_project(size_mb):
+    """Returns a serialized project with build systems and settings adding
+    up to roughly size_mb megabytes."""
+
+    build_systems = []
+    size = 0
+    while size < size_mb * 1024 * 1024:
+        build = {
+            'name': 'Build {0}'.format(len(build_systems)),
+            'shell_cmd': 'make -C ${{project_path}} target-{0}'.format(len(build_systems)),
+            'file_regex': '^(..[^:]*):([0-9]+):?([0-9]+)?:? (.*)$',
+            'env': dict(('VAR_{0}'.format(i), 'value-{0}'.format(i) * 4) for i in range(20)),
+        }
+        size += len(json.dumps(build))
+        build_systems.append(build)
+    return json.dumps({
+        'name': 'benchmark',
+        'folders': [{'path': '/bench/project'}],
+        'settings': dict(('setting_{0}'.format(i), i) for i in range(500)),
+        'build_systems': build_systems,
+    })
+
+
+class ProjectWindow(Window):
+
+    def __init__(self, window_id, raw_project):
+        Window.__init__(self, window_id)
+        self.raw_project = raw_project
+        self.project_data_calls = 0
+
+    def folders(self):
+        return ['/bench/project']
+
+    def project_file_name(self):
+        return '/bench/project/benchmark.sublime-project'
+
+    def project_data(self):
+        # Sublime returns a freshly deserialized copy on every call
+        self.project_data_calls += 1
+        return json.loads(self.raw_project)
+
+
+def measure(run):
+    tracemalloc.start()
+    started = time.time()
+    retained = run()
+    elapsed = time.time() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del retained
+    return current, peak, elapsed
+
+
+def bench_uncached(window, entities):
+    queued = []
+
+    def run():
+        for entity in entities:
+            queued.append({
+                'entity': entity,
+                'project': window.project_data(),
+                'folders': window.folders(),
+            })
+        return queued
+
+    return measure(run)
+
+
+def bench_cached(plugin, fake, window, entities):
+    listener = plugin.WakatimeListener()
+
+    def run():
+        for num, entity in enumerate(entities):
+            fake.clock.advance(fake.clock.now + 10)
+            view = View(num + 1, window)
+            view._file_name = entity
+            fake.focus(view)
+            listener.on_modified(view)
+        return plugin.HEARTBEATS
+
+    return measure(run)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark project data memory while queueing heartbeats.')
+    parser.add_argument('--size-mb', type=float, default=4, help='size of the serialized project file')
+    parser.add_argument('--heartbeats', type=int, default=200, help='number of queued heartbeats')
+    args = parser.parse_args(argv)
+
+    os.environ['WAKATIME_HOME'] = tempfile.mkdtemp(prefix='wakatime-bench-')
+
+    raw_project = large_project(args.size_mb)
+    entities = ['/bench/project/src/file{0}.py'.format(i) for i in range(args.heartbeats)]
+
+    settings = default_settings()
+    settings.update({'local_activity_db': False, 'heartbeat_burst': args.heartbeats})
+    fake = FakeSublime(Clock(time.time()), Settings(settings))
+    plugin = load_plugin(fake)
+    plugin.time = fake.clock
+    plugin.SETTINGS = fake.settings
+    plugin.IDLE = plugin.IdleTracker()
+
+    window = ProjectWindow(1, raw_project)
+    fake.windows[1] = window
+    current, peak, elapsed = bench_uncached(window, entities)
+    calls = window.project_data_calls
+    print('Project file size:      {0:.1f} MB'.format(len(raw_project) / 1024.0 / 1024.0))
+    print('Queued heartbeats:      {0}'.format(len(entities)))
+    print('project_data per event: {0} calls, {1:.1f} MB retained, {2:.1f} MB peak, {3:.2f}s'.format(
+        calls, current / 1024.0 / 1024.0, peak / 1024.0 / 1024.0, elapsed))
+
+    window = ProjectWindow(2, raw_project)
+    fake.windows = {2: window}
+    current, peak, elapsed = bench_cached(plugin, fake, window, entities)
+    print('Cached project name:    {0} calls, {1:.1f} MB retained, {2:.1f} MB peak, {3:.2f}s'.format(
+        window.project_data_calls, current / 1024.0 / 1024.0, peak / 1024.0 / 1024.0, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" ==========================================================
+File:        replay_trace.py
+Description: Replays a recorded WakaTime activity trace through the
+             plugin outside of Sublime Text.
+Maintainer:  WakaTime <support@wakatime.com>
+License:     BSD, see LICENSE for more details.
+Website:     https://wakatime.com/
+===========================================================
+
+Record a trace by setting "trace_activity": true in your WakaTime user
+settings, then replay it with:
+
+    python scripts/replay_trace.py ~/.wakatime/sublime-trace.jsonl
+
+The plugin is loaded with fake sublime and sublime_plugin modules and a
+virtual clock. Listener events from the trace are fed to WakatimeListener
+and every timer the plugin schedules runs at its virtual due time. Nothing
+is sent to wakatime-cli unless another --backend is chosen with --cli
+pointing at the wakatime-cli to run, the flushes are recorded by the memory
+sender instead. By default the trace replays as fast as possible, use
+--speed 1 for real time.
+"""
+
+
+import argparse
+import heapq
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+
+
+PACKAGE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_FILE = os.path.join(PACKAGE_FOLDER, 'WakaTime.py')
+SETTINGS_FILE = os.path.join(PACKAGE_FOLDER, 'WakaTime.sublime-settings')
+
+
+class Clock(object):
+    """Virtual clock which runs scheduled callbacks in due order.
+
+    Stands in for the plugin's time module, other attributes are taken from
+    the real one.
+    """
+
+    def __init__(self, start, speed=0):
+        self.now = start
+        self.speed = speed
+        self.timers = []
+        self.seq = 0
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(self.now + seconds)
+
+    def call_later(self, callback, seconds):
+        self.seq += 1
+        heapq.heappush(self.timers, (self.now + max(seconds, 0), self.seq, callback))
+
+    def advance(self, until):
+        while self.timers and self.timers[0][0] <= until:
+            when, _seq, callback = heapq.heappop(self.timers)
+            self._wait(when)
+            callback()
+        self._wait(until)
+
+    def drain(self):
+        while self.timers:
+            self.advance(self.timers[0][0])
+
+    def _wait(self, until):
+        if until <= self.now:
+            return
+        if self.speed:
+            time.sleep((until - self.now) / float(self.speed))
+        self.now = until
+
+
+class Settings(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class Region(object):
+
+    def __init__(self, point):
+        self.point = point
+
+    def begin(self):
+        return self.point
+
+
+class Window(object):
+
+    def __init__(self, window_id):
+        self._id = window_id
+        self._active_view = None
+
+    def id(self):
+        return self._id
+
+    def active_view(self):
+        return self._active_view
+
+    def views(self):
+        return [self._active_view] if self._active_view else []
+
+    def folders(self):
+        return []
+
+    def project_file_name(self):
+        return None
+
+    def project_data(self):
+        return None
+
+
+class View(object):
+
+    def __init__(self, view_id, window):
+        self._id = view_id
+        self._window = window
+        self._file_name = None
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._id
+
+    def window(self):
+        return self._window
+
+    def file_name(self):
+        return self._file_name
+
+    def size(self):
+        return 0
+
+    def rowcol(self, point):
+        return (0, 0)
+
+    def sel(self):
+        return [Region(0)]
+
+    def set_status(self, key, value):
+        pass
+
+    def settings(self):
+        return Settings()
+
+
+class FakeSublime(object):
+    """Holds the state behind the fake sublime module."""
+
+    def __init__(self, clock, settings):
+        self.clock = clock
+        self.settings = settings
+        self.windows = {}
+        self.views = {}
+        self.active_window = None
+
+    def module(self):
+        sublime = types.ModuleType('sublime')
+        sublime.version = lambda: '4126'
+        sublime.windows = lambda: list(self.windows.values())
+        sublime.active_window = lambda: self.active_window
+        sublime.set_timeout = lambda cb, ms: self.clock.call_later(cb, ms / 1000.0)
+        sublime.set_timeout_async = sublime.set_timeout
+        sublime.load_settings = lambda name: self.settings
+        sublime.save_settings = lambda name: None
+        sublime.status_message = lambda msg: None
+        return sublime
+
+    def view(self, view_id, window_id):
+        view = self.views.get(view_id)
+        if view is not None and window_id is None:
+            return view  # older traces didn't record the window of every event
+        window = self.windows.get(window_id)
+        if window is None:
+            window = Window(window_id)
+            self.windows[window_id] = window
+        if view is None:
+            view = View(view_id, window)
+            self.views[view_id] = view
+        elif view.window() is not window:
+            # the view was dragged to another window
+            view._window = window
+        return view
+
+    def focus(self, view):
+        self.active_window = view.window()
+        view.window()._active_view = view
+
+
+def sublime_plugin_module():
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('EventListener', 'ApplicationCommand', 'WindowCommand', 'TextCommand'):
+        setattr(sublime_plugin, name, type(name, (object,), {}))
+    return sublime_plugin
+
+
+def load_plugin(fake):
+    sys.modules['sublime'] = fake.module()
+    sys.modules['sublime_plugin'] = sublime_plugin_module()
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('WakaTime', PLUGIN_FILE)
+        plugin = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(plugin)
+    except ImportError:
+        import imp
+        plugin = imp.load_source('WakaTime', PLUGIN_FILE)
+    return plugin
+
+
+def default_settings():
+    """Returns the package's default settings, skipping comment lines."""
+
+    with open(SETTINGS_FILE) as fh:
+        lines = [line for line in fh if not line.strip().startswith('//')]
+    return json.loads(''.join(lines))
+
+
+def read_trace(path):
+    events, heartbeats = [], []
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('e') == 'event':
+                events.append(record)
+            elif record.get('e') == 'heartbeat':
+                heartbeats.append(record)
+    events.sort(key=lambda x: x['t'])
+    return events, heartbeats
+
+
+def wait_for_sends(plugin):
+    """Blocks until no wakatime-cli sends are in flight."""
+
+    for _ in range(plugin.MAX_INFLIGHT_SENDS):
+        plugin.INFLIGHT_SENDS.acquire()
+    for _ in range(plugin.MAX_INFLIGHT_SENDS):
+        plugin.INFLIGHT_SENDS.release()
+
+
+def replay(events, speed=0, settings=None, backend='memory', cli=None):
+    """Feeds the events through the plugin and returns replay stats."""
+
+    clock = Clock(events[0]['t'] if events else 0, speed=speed)
+    fake = FakeSublime(clock, Settings(settings or {}))
+    plugin = load_plugin(fake)
+    plugin.time = clock
+    plugin.SETTINGS = fake.settings
+    plugin.IDLE = plugin.IdleTracker()
+    plugin.isCliInstalled = lambda: True
+    if backend == 'memory':
+        memory = plugin.MemorySender()
+        plugin.get_sender = lambda: memory
+    else:
+        fake.settings['sender_backend'] = backend
+        plugin.WAKATIME_CLI_LOCATION = cli
+
+    stats = {
+        'events': 0,
+        'heartbeats': 0,
+        'today_fetches': 0,
+    }
+
+    class RecordingFetch(object):
+
+        def start(self):
+            stats['today_fetches'] += 1
+
+    plugin.FetchStatusBarCodingTime = RecordingFetch
+
+    original_queue = plugin.queue_heartbeat
+
+    def queue_heartbeat(*args, **kwargs):
+        stats['heartbeats'] += 1
+        return original_queue(*args, **kwargs)
+
+    plugin.queue_heartbeat = queue_heartbeat
+
+    cli_flushes = []
+    if backend != 'memory':
+        original_deliver = plugin.deliver
+        original_process = plugin.process_queue
+
+        def deliver(sender, heartbeats):
+            cli_flushes.append((clock.now, len(heartbeats)))
+            return original_deliver(sender, heartbeats)
+
+        def process_queue(*args, **kwargs):
+            # wait for wakatime-cli, so sends finish at this virtual time
+            original_process(*args, **kwargs)
+            wait_for_sends(plugin)
+
+        plugin.deliver = deliver
+        plugin.process_queue = process_queue
+
+    listener = plugin.WakatimeListener()
+    handlers = {
+        'modified': listener.on_modified,
+        'selection': listener.on_selection_modified,
+        'save': listener.on_post_save,
+        'activated': listener.on_activated,
+        'deactivated': listener.on_deactivated,
+    }
+
+    started = time.time()
+    for event in events:
+        clock.advance(event['t'])
+        handler = handlers.get(event.get('kind'))
+        if handler is None:
+            continue
+        view = fake.view(event['view'], event.get('window'))
+        if event.get('entity'):
+            view._file_name = event['entity']
+        if event['kind'] != 'deactivated':
+            fake.focus(view)
+        handler(view)
+        stats['events'] += 1
+    clock.drain()
+    sender = plugin.get_sender()
+    if isinstance(sender, plugin.MemorySender):
+        stats['flushes'] = [(when, len(batch)) for when, batch in sender.sent]
+    else:
+        sender.stop()
+        stats['flushes'] = cli_flushes
+    stats['sender'] = sender.stats()
+    stats['suppressed'] = plugin.RATE_LIMITER.suppressed
+    stats['wall_seconds'] = time.time() - started
+    stats['virtual_seconds'] = (events[-1]['t'] - events[0]['t']) if events else 0
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a WakaTime activity trace through the plugin.')
+    parser.add_argument('trace', help='JSONL trace recorded with the trace_activity setting')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed multiplier, 1 for real time, 0 (default) for as fast as possible')
+    parser.add_argument('--setting', action='append', default=[], metavar='KEY=JSON',
+                        help='plugin setting to use during replay, can be repeated')
+    parser.add_argument('--backend', default='memory', choices=['memory', 'cli', 'persistent_cli'],
+                        help='sender backend, the cli backends run the wakatime-cli given with --cli')
+    parser.add_argument('--cli', metavar='PATH',
+                        help='wakatime-cli to run with the cli backends, WAKATIME_HOME is a temporary folder so it needs its own api key')
+    parser.add_argument('--json', action='store_true', help='print stats as json')
+    args = parser.parse_args(argv)
+    if args.backend != 'memory' and not args.cli:
+        parser.error('--backend {0} requires --cli'.format(args.backend))
+
+    settings = default_settings()
+    for setting in args.setting:
+        key, _, value = setting.partition('=')
+        settings[key] = json.loads(value)
+
+    # keep the plugin from touching the real ~/.wakatime folder
+    os.environ['WAKATIME_HOME'] = tempfile.mkdtemp(prefix='wakatime-replay-')
+
+    events, recorded = read_trace(args.trace)
+    stats = replay(events, speed=args.speed, settings=settings, backend=args.backend, cli=args.cli)
+    stats['recorded_heartbeats'] = len(recorded)
+
+    if args.json:
+        print(json.dumps(stats))
+        return
+
+    flushes = stats['flushes']
+    sent = sum(size for _, size in flushes)
+    sender = stats['sender']
+    print('Events replayed:       {0}'.format(stats['events']))
+    print('Heartbeats recorded:   {0}'.format(stats['recorded_heartbeats']))
+    print('Heartbeats replayed:   {0}'.format(stats['heartbeats']))
+    print('Heartbeats suppressed: {0}'.format(stats['suppressed']))
+    print('Flushes:               {0}'.format(len(flushes)))
+    print('Heartbeats per flush:  {0:.2f}'.format(float(sent) / len(flushes) if flushes else 0))
+    print('Sender:                {0}, {1} batches, {2} failures'.format(
+        sender['backend'], sender['batches'], sender['failures']))
+    print('Sender latency:        avg {0:.2f}ms, max {1:.2f}ms'.format(
+        sender['avg_latency_ms'], sender['max_latency_ms']))
+    print('Today fetches:         {0}'.format(stats['today_fetches']))
+    print('Trace duration:        {0:.1f}s'.format(stats['virtual_seconds']))
+    print('Replay duration:       {0:.3f}s'.format(stats['wall_seconds']))
+
+
+if __name__ == '__main__':
+    main()